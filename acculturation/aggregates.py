@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import random
+import hashlib
+from collections import Counter, defaultdict
+import numpy as np
+
+"""
+This file includes a small container for summing
+term (or lexicon category) counts per group while
+documents stream by.
+
+Distances only depend on each group's summed counts,
+so keeping these sums instead of the documents themselves
+bounds memory by groups x vocabulary and lets the corpus
+be read in a single pass.
+
+Group keys can be any hashable value, e.g. a group name,
+a (sender, recipient) tuple for dyads, etc.
+
+Aggregates can also be cached on disk (see
+load_cached_aggregates), so that repeated measurements
+over an unchanged corpus do not have to read it again.
+"""
+
+
+class GroupAggregates:
+
+    def __init__(self):
+        # group -> Counter over terms
+        self.counts = defaultdict(Counter)
+        # group -> number of documents folded in
+        self.n_docs = Counter()
+
+    def __contains__(self, key):
+        return key in self.n_docs
+
+    def __len__(self):
+        return len(self.n_docs)
+
+    def keys(self):
+        return self.n_docs.keys()
+
+    def add(self, key, terms):
+        """
+        Folds one document's terms into group key.
+        terms may be a dict of counts or a list of terms.
+        """
+        self.counts[key].update(terms)
+        self.n_docs[key] += 1
+
+    def merge(self, other):
+        """
+        Adds all counts from another GroupAggregates
+        into this one (in place), and returns self.
+        """
+        for key, counts in other.counts.items():
+            self.counts[key].update(counts)
+        self.n_docs.update(other.n_docs)
+        return self
+
+    def subtract(self, other):
+        """
+        Removes counts previously merged in from another
+        GroupAggregates (in place), dropping groups left
+        without documents, and returns self.
+        """
+        for key, counts in other.counts.items():
+            own = self.counts[key]
+            own.subtract(counts)
+            for term in counts:
+                if own[term] == 0:
+                    del own[term]
+        self.n_docs.subtract(other.n_docs)
+        for key in other.n_docs:
+            if self.n_docs[key] <= 0:
+                del self.n_docs[key]
+                self.counts.pop(key, None)
+        return self
+
+    def get_counts(self, key):
+        return self.counts.get(key, Counter())
+
+    @classmethod
+    def from_arrays(cls, keys, categories, sums, n_docs):
+        """
+        Builds aggregates from a keys x categories matrix of
+        count sums and per-key document counts (e.g. from
+        columnar.ColumnarDataReader.sum_counts_by_column).
+        """
+        aggregates = cls()
+        for key, row, n in zip(keys, sums.tolist(), n_docs.tolist()):
+            aggregates.counts[key] = Counter({c: v for c, v in zip(categories, row) if v})
+            aggregates.n_docs[key] = n
+        return aggregates
+
+    def to_arrays(self):
+        """
+        Inverse of from_arrays: returns (keys, categories,
+        sums, n_docs) with a keys x categories sums matrix
+        """
+        keys = list(self.n_docs.keys())
+        categories = sorted(set(c for key in keys for c in self.counts[key]))
+        cat2i = {c: i for i, c in enumerate(categories)}
+        sums = np.zeros((len(keys), len(categories)), dtype=np.int64)
+        for i, key in enumerate(keys):
+            for c, v in self.counts[key].items():
+                sums[i, cat2i[c]] = v
+        n_docs = np.array([self.n_docs[key] for key in keys], dtype=np.int64)
+        return keys, categories, sums, n_docs
+
+
+class GroupReservoirSampler:
+
+    """
+    Keeps a uniform random sample of at most sampsize
+    items per group while items stream by (Algorithm R),
+    and counts how many items each group has seen.
+    """
+
+    def __init__(self, sampsize, seed=None):
+        self.sampsize = sampsize
+        self.rng = random.Random(seed)
+        # group -> list of at most sampsize items
+        self.samples = defaultdict(list)
+        # group -> number of items seen
+        self.n_seen = Counter()
+
+    def keys(self):
+        return self.n_seen.keys()
+
+    def add(self, key, item):
+        self.n_seen[key] += 1
+        sample = self.samples[key]
+        if len(sample) < self.sampsize:
+            sample.append(item)
+        else:
+            # Replace a kept item with probability sampsize / n_seen
+            j = self.rng.randrange(self.n_seen[key])
+            if j < self.sampsize:
+                sample[j] = item
+
+
+def get_aggregates(documents, aggregate_fnc, spec, cache_dir=None, verbose=True):
+    """
+    Returns aggregate_fnc(documents), reusing aggregates cached
+    in cache_dir by an earlier call with the same spec, if the
+    input files (documents.fns) have not changed since.
+
+    Input args:
+        documents - a data reader with an fns list of input files
+            (documents without one are always aggregated)
+        aggregate_fnc (fnc) - returns GroupAggregates for documents
+        spec (tuple) - whatever else determines the aggregates,
+            e.g. the kind of grouping, grouping key and terms key
+        cache_dir (string) - cache directory, or None for no cache
+    """
+    fns = getattr(documents, 'fns', None)
+    if cache_dir is None or fns is None:
+        return aggregate_fnc(documents)
+    fingerprint = aggregates_fingerprint(fns, *spec)
+    aggregates = load_cached_aggregates(cache_dir, fingerprint)
+    if aggregates is not None:
+        if verbose:
+            sys.stderr.write('Using cached aggregates for %d groups from %s\n' % (len(aggregates), cache_dir))
+        return aggregates
+    aggregates = aggregate_fnc(documents)
+    save_cached_aggregates(cache_dir, fingerprint, aggregates)
+    return aggregates
+
+
+def aggregates_fingerprint(fns, *spec):
+    """
+    Returns a key for aggregates of input files fns made
+    with the given spec (e.g. grouping key and terms key),
+    which changes whenever a file's path, size or
+    modification time does.
+    """
+    files = []
+    for fn in sorted(fns):
+        st = os.stat(fn)
+        files.append((os.path.abspath(fn), st.st_size, st.st_mtime_ns))
+    return hashlib.sha1(json.dumps([files, spec]).encode('utf-8')).hexdigest()
+
+
+def load_cached_aggregates(cache_dir, fingerprint):
+    """
+    Returns the GroupAggregates cached under fingerprint
+    in cache_dir, or None if there are none
+    """
+    fn = os.path.join(cache_dir, fingerprint + '.npz')
+    if not os.path.exists(fn):
+        return None
+    aggregates, _ = load_aggregates(fn)
+    return aggregates
+
+
+def save_cached_aggregates(cache_dir, fingerprint, aggregates):
+    """
+    Caches aggregates under fingerprint in cache_dir
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    save_aggregates(aggregates, os.path.join(cache_dir, fingerprint + '.npz'))
+
+
+def save_aggregates(aggregates, fn, **meta):
+    """
+    Saves aggregates to fn (an .npz file), along with any
+    json-serializable metadata given as keyword arguments.
+    Keys must be strings, numbers or tuples of those.
+    """
+    keys, categories, sums, n_docs = aggregates.to_arrays()
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        np.savez(f, keys=json.dumps(keys), categories=json.dumps(categories),
+                    sums=sums, n_docs=n_docs, meta=json.dumps(meta))
+        f.close()
+    os.replace(tmp_fn, fn)
+
+
+def load_aggregates(fn):
+    """
+    Returns (aggregates, metadata dict) saved with save_aggregates
+    """
+    with np.load(fn) as saved:
+        keys = [_to_key(k) for k in json.loads(str(saved['keys']))]
+        categories = json.loads(str(saved['categories']))
+        meta = json.loads(str(saved['meta'])) if 'meta' in saved.files else {}
+        return GroupAggregates.from_arrays(keys, categories, saved['sums'], saved['n_docs']), meta
+
+
+def _to_key(k):
+    # json turns tuple keys into lists
+    return tuple(_to_key(x) for x in k) if isinstance(k, list) else k
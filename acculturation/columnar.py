@@ -0,0 +1,305 @@
+import os
+import json
+import numpy as np
+
+"""
+This file includes a columnar on-disk format for
+preprocessed corpora, as an alternative to line-by-line
+JSON for the measurement stage.
+
+A columnar corpus is a directory holding:
+    manifest.json - number of documents, lexicon categories
+        (in column order), terms key and metadata columns.
+        Written last, so a directory without one is incomplete.
+    counts.bin - a documents x categories matrix of int32
+        category counts (raw, row-major, little-endian),
+        which readers memory-map instead of parsing.
+    colN.offsets.npy, colN.codes.npy, colN.values.json - one
+        dictionary-encoded metadata column (e.g. 'from', 'to',
+        'date' or a group key). Document i's values are
+        values[codes[offsets[i]:offsets[i+1]]], so that
+        list-valued columns like 'to' fit the same layout.
+
+Columnar corpora are written by preprocess_docs
+(out_format='columnar') and read with ColumnarDataReader,
+which can also sum counts per group, dyad or user
+without building per-document Python objects.
+"""
+
+MANIFEST_FN = "manifest.json"
+COUNTS_FN = "counts.bin"
+COLUMNAR_FORMAT = "acculturation-columnar"
+
+
+def is_columnar_corpus(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FN))
+
+
+class ColumnarCorpusWriter:
+
+    """
+    Streams preprocessed documents into a columnar corpus
+    directory. Category counts go straight to disk; metadata
+    column codes are kept in memory until close().
+    """
+
+    def __init__(self, out_dir, categories, columns=('from', 'to', 'date'),
+                        terms_key='terms'):
+        os.makedirs(out_dir, exist_ok=True)
+        if os.path.exists(os.path.join(out_dir, MANIFEST_FN)):
+            os.remove(os.path.join(out_dir, MANIFEST_FN))
+        self.out_dir = out_dir
+        self.categories = list(categories)
+        self.cat2id = {c: i for i, c in enumerate(self.categories)}
+        self.terms_key = terms_key
+        self.columns = [_ColumnBuilder(name) for name in columns]
+        self.n_docs = 0
+        self._countsf = open(os.path.join(out_dir, COUNTS_FN), 'wb')
+
+    def write(self, d):
+        row = np.zeros(len(self.categories), dtype='<i4')
+        for cat, count in d[self.terms_key].items():
+            if cat not in self.cat2id:
+                raise ValueError("category '%s' is not in the corpus categories" % cat)
+            row[self.cat2id[cat]] = count
+        self._countsf.write(row.tobytes())
+        for col in self.columns:
+            col.append(d.get(col.name))
+        self.n_docs += 1
+
+    def close(self):
+        self._countsf.close()
+        columns = []
+        for i, col in enumerate(self.columns):
+            fn = "col%d" % i
+            col.save(os.path.join(self.out_dir, fn))
+            columns.append({"name": col.name, "file": fn, "list": col.is_list})
+        manifest = {
+            "format": COLUMNAR_FORMAT,
+            "version": 1,
+            "n_docs": self.n_docs,
+            "terms_key": self.terms_key,
+            "categories": self.categories,
+            "counts_dtype": "<i4",
+            "columns": columns
+        }
+        tmp_fn = os.path.join(self.out_dir, MANIFEST_FN + ".tmp")
+        with open(tmp_fn, 'w') as f:
+            json.dump(manifest, f, indent=1)
+            f.close()
+        os.replace(tmp_fn, os.path.join(self.out_dir, MANIFEST_FN))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._countsf.close()
+        if exc[0] is None:
+            self.close()
+
+
+class _ColumnBuilder:
+
+    def __init__(self, name):
+        self.name = name
+        self.is_list = False
+        self.values = []
+        self.value2code = {}
+        self.codes = []
+        self.offsets = [0]
+
+    def append(self, value):
+        if isinstance(value, list):
+            self.is_list = True
+            items = value
+        else:
+            items = [] if value is None else [value]
+        for v in items:
+            code = self.value2code.get(v)
+            if code is None:
+                code = self.value2code[v] = len(self.values)
+                self.values.append(v)
+            self.codes.append(code)
+        self.offsets.append(len(self.codes))
+
+    def save(self, prefix):
+        np.save(prefix + ".offsets.npy", np.array(self.offsets, dtype=np.int64))
+        np.save(prefix + ".codes.npy", np.array(self.codes, dtype=np.int32))
+        with open(prefix + ".values.json", 'w') as f:
+            json.dump(self.values, f)
+            f.close()
+
+
+
+class ColumnarDataReader:
+
+    """
+    Reads a columnar corpus directory.
+
+    Iterating yields documents as dictionaries with the
+    stored metadata columns and a terms dict of nonzero
+    category counts, like JsonDataReader does for JSON output.
+
+    The counts matrix itself is available (memory-mapped)
+    as self.counts, and sum_counts_by_* return per-key count
+    sums computed with numpy over the whole matrix.
+    """
+
+    def __init__(self, path, fields=None, chunk_size=2**16):
+        with open(os.path.join(path, MANIFEST_FN)) as f:
+            self.manifest = json.load(f)
+            f.close()
+        if self.manifest.get("format") != COLUMNAR_FORMAT:
+            raise ValueError("'%s' is not a columnar corpus" % path)
+        self.path = path
+        self.fields = fields
+        self.chunk_size = chunk_size
+        self.n_docs = self.manifest["n_docs"]
+        self.categories = self.manifest["categories"]
+        self.terms_key = self.manifest["terms_key"]
+        n_cats = len(self.categories)
+        if self.n_docs and n_cats:
+            self.counts = np.memmap(os.path.join(path, COUNTS_FN), mode='r',
+                                        dtype=self.manifest["counts_dtype"],
+                                        shape=(self.n_docs, n_cats))
+        else:
+            self.counts = np.zeros((self.n_docs, n_cats), dtype=self.manifest["counts_dtype"])
+        self._columns = {c["name"]: c for c in self.manifest["columns"]}
+        self._loaded = {}
+        # All files of the corpus (e.g. for fingerprinting)
+        self.fns = [os.path.join(path, MANIFEST_FN), os.path.join(path, COUNTS_FN)]
+        for c in self.manifest["columns"]:
+            prefix = os.path.join(path, c["file"])
+            self.fns += [prefix + ".offsets.npy", prefix + ".codes.npy", prefix + ".values.json"]
+
+    def __len__(self):
+        return self.n_docs
+
+    def column_names(self):
+        return list(self._columns.keys())
+
+    def column(self, name):
+        """
+        Returns (offsets, codes, values) for a metadata column
+        """
+        if name not in self._loaded:
+            if name not in self._columns:
+                raise KeyError("columnar corpus has no '%s' column" % name)
+            prefix = os.path.join(self.path, self._columns[name]["file"])
+            offsets = np.load(prefix + ".offsets.npy", mmap_mode='r')
+            codes = np.load(prefix + ".codes.npy", mmap_mode='r')
+            with open(prefix + ".values.json") as f:
+                values = json.load(f)
+                f.close()
+            self._loaded[name] = (offsets, codes, values)
+        return self._loaded[name]
+
+    def __iter__(self):
+        names = [n for n in self._columns if self.fields is None or n in self.fields]
+        want_terms = self.fields is None or self.terms_key in self.fields
+        columns = [(n, self._columns[n]["list"]) + self.column(n) for n in names]
+        for start in range(0, self.n_docs, self.chunk_size):
+            end = min(start + self.chunk_size, self.n_docs)
+            counts = np.asarray(self.counts[start:end])
+            decoded = []
+            for name, is_list, offsets, codes, values in columns:
+                offs = np.asarray(offsets[start:end+1])
+                chunk_codes = np.asarray(codes[offs[0]:offs[-1]]).tolist()
+                offs = (offs - offs[0]).tolist()
+                rows = [[values[c] for c in chunk_codes[offs[i]:offs[i+1]]] for i in range(end - start)]
+                if not is_list:
+                    rows = [r[0] if r else None for r in rows]
+                decoded.append((name, rows))
+            for i in range(end - start):
+                d = {name: rows[i] for name, rows in decoded}
+                if want_terms:
+                    row = counts[i]
+                    d[self.terms_key] = {self.categories[j]: int(row[j]) for j in np.flatnonzero(row)}
+                yield d
+
+    def sum_counts_by_column(self, name):
+        """
+        Sums category counts per distinct value of a metadata
+        column (each value of a list-valued column counts as a
+        group, repeated values once). Documents without a value
+        are skipped, as jensen_shannon.get_document_groups does
+        for null values (columns store missing and null values
+        alike). Raises KeyError if the corpus has no such column.
+        Returns (keys, sums, n_docs).
+        """
+        offsets, codes, values = self.column(name)
+        rows, keys = _expand(offsets, codes)
+        return self._sum_by_key(rows, keys, values)
+
+    def sum_counts_by_dyad(self, from_key='from', to_key='to'):
+        """
+        Sums category counts per (sender, recipient) pair,
+        not counting messages to oneself.
+        Returns (keys, sums, n_docs) with (sender, recipient) keys.
+        """
+        users, senders, (rows, r) = self._senders_recipients(from_key, to_key)
+        s = senders[rows]
+        keep = s != r
+        rows, s, r = rows[keep], s[keep], r[keep]
+        n_users = len(users)
+        uniq, inverse = np.unique(s * n_users + r, return_inverse=True)
+        labels = [(users[k // n_users], users[k % n_users]) for k in uniq.tolist()]
+        return self._sum_by_key(rows, inverse.reshape(-1), labels)
+
+    def sum_counts_by_user(self, from_key='from', to_key='to'):
+        """
+        Sums category counts of the messages each user sent
+        and of the messages each user received (from others).
+        Returns (keys, sums, n_docs) with ('sent', user) and
+        ('received', user) keys.
+        """
+        users, senders, (rows, r) = self._senders_recipients(from_key, to_key)
+        n_users = len(users)
+        keep = senders[rows] != r
+        sent_rows = np.flatnonzero(senders >= 0)
+        rows = np.concatenate([sent_rows, rows[keep]])
+        keys = np.concatenate([senders[sent_rows], n_users + r[keep]])
+        labels = [('sent', u) for u in users] + [('received', u) for u in users]
+        return self._sum_by_key(rows, keys, labels)
+
+    def _senders_recipients(self, from_key, to_key):
+        # Maps 'from' and 'to' values into one shared user index.
+        # Returns the users, each document's sender id (-1 if none),
+        # and (row, recipient id) arrays for documents with a sender
+        f_offsets, f_codes, f_values = self.column(from_key)
+        t_offsets, t_codes, t_values = self.column(to_key)
+        users = sorted(set(f_values) | set(t_values))
+        user2id = {u: i for i, u in enumerate(users)}
+        f_map = np.array([user2id[v] for v in f_values] or [0], dtype=np.int64)
+        t_map = np.array([user2id[v] for v in t_values] or [0], dtype=np.int64)
+        f_rows, f_ids = _expand(f_offsets, f_codes)
+        senders = np.full(self.n_docs, -1, dtype=np.int64)
+        senders[f_rows] = f_map[f_ids]
+        t_rows, t_ids = _expand(t_offsets, t_codes)
+        has_sender = senders[t_rows] >= 0
+        return users, senders, (t_rows[has_sender], t_map[t_ids[has_sender]])
+
+    def _sum_by_key(self, rows, keys, labels):
+        # Each (row, key) pair is counted once
+        n_keys = len(labels)
+        if len(rows):
+            pairs = np.unique(rows.astype(np.int64) * max(n_keys, 1) + keys)
+            rows, keys = pairs // max(n_keys, 1), pairs % max(n_keys, 1)
+        n_docs = np.bincount(keys, minlength=n_keys)
+        sums = np.zeros((n_keys, len(self.categories)), dtype=np.int64)
+        for start in range(0, len(rows), self.chunk_size * 16):
+            r = rows[start:start + self.chunk_size * 16]
+            k = keys[start:start + self.chunk_size * 16]
+            counts = np.asarray(self.counts[r])
+            for j in range(len(self.categories)):
+                sums[:, j] += np.bincount(k, weights=counts[:, j], minlength=n_keys).astype(np.int64)
+        used = np.flatnonzero(n_docs)
+        return [labels[i] for i in used], sums[used], n_docs[used]
+
+
+def _expand(offsets, codes):
+    # Returns (row, code) arrays for every value of a column
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)
+    rows = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    return rows, np.asarray(codes, dtype=np.int64)
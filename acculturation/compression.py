@@ -0,0 +1,122 @@
+import io
+import bz2
+import gzip
+import lzma
+import queue
+import threading
+
+"""
+This file includes helpers for reading and writing text files
+that may be compressed, as chosen by their extension
+(e.g. 'enron.json.gz'), using only the standard library codecs.
+
+Compressed files are decompressed on a background thread, one
+large block ahead of the reader: zlib, bz2 and lzma release the
+GIL while they work, so decompression overlaps with parsing
+whatever was decompressed before, instead of adding to it.
+"""
+
+COMPRESSED_OPENERS = {
+    'gz': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open
+}
+
+# Bytes read (or decompressed) at a time
+READ_BLOCK_SIZE = 2**22
+
+
+def compression_ext(fn):
+    """
+    Returns the compression extension of fn ('gz', 'bz2'
+    or 'xz'), or None if fn is not compressed
+    """
+    ext = fn.split(".")[-1].lower()
+    return ext if ext in COMPRESSED_OPENERS else None
+
+
+def strip_compression_ext(fn):
+    """
+    Returns fn without its compression extension, if any
+    (e.g. 'enron.json.gz' -> 'enron.json')
+    """
+    ext = compression_ext(fn)
+    return fn[:-len(ext)-1] if ext else fn
+
+
+def open_text(fn, mode='r', block_size=READ_BLOCK_SIZE):
+    """
+    Opens fn as a utf-8 text file for reading ('r'), writing
+    ('w') or appending ('a'), compressing or decompressing it
+    if its name ends in .gz, .bz2 or .xz.
+    """
+    ext = compression_ext(fn)
+    if mode == 'r':
+        if ext is None:
+            return open(fn, 'r', encoding='utf-8', buffering=block_size)
+        raw = _ReadAheadFile(COMPRESSED_OPENERS[ext](fn, 'rb'), block_size)
+        return io.TextIOWrapper(io.BufferedReader(raw, buffer_size=block_size), encoding='utf-8')
+    if mode not in ('w', 'a'):
+        raise ValueError("unsupported mode '%s'" % mode)
+    if ext is None:
+        return open(fn, mode, encoding='utf-8')
+    # Text mode of the compressed openers does its own buffering
+    return COMPRESSED_OPENERS[ext](fn, mode + 't', encoding='utf-8')
+
+
+class _ReadAheadFile(io.RawIOBase):
+
+    """
+    Raw binary stream over f, whose blocks are read by a
+    background thread and handed over through a bounded queue
+    """
+
+    def __init__(self, f, block_size, depth=2):
+        self._blocks = queue.Queue(depth)
+        self._block = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, args=(f, block_size), daemon=True)
+        self._thread.start()
+
+    def _fill(self, f, block_size):
+        try:
+            with f:
+                while not self._stop.is_set():
+                    block = f.read(block_size)
+                    self._blocks.put(block)
+                    if not block:
+                        return
+        except Exception as e:
+            self._blocks.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._block:
+            if self._eof:
+                return 0
+            block = self._blocks.get()
+            if isinstance(block, Exception):
+                self._eof = True
+                raise block
+            if not block:
+                self._eof = True
+                return 0
+            self._block = memoryview(block)
+        n = min(len(b), len(self._block))
+        b[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            # Unblock and stop the reading thread
+            self._stop.set()
+            while self._thread.is_alive():
+                try:
+                    self._blocks.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+        super().close()
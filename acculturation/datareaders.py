@@ -3,6 +3,13 @@ import os
 import csv
 import json
 import re
+import mailbox
+import tarfile
+import zipfile
+import multiprocessing
+
+from acculturation.compression import open_text, strip_compression_ext
+from acculturation.parallel import iter_chunks, imap_bounded
 
 try:
     import mailparser
@@ -21,13 +28,14 @@ except:
 def _get_fns_from_dir(dir_fn, ext):
     """
     Search dir and subdirs for all files with given extension
+    (or all files, if ext is None)
     """
     if not os.path.isdir(dir_fn):
         # Input is a filename not a dir
         return [dir_fn]
     fns = []
     for root, dirs, files in os.walk(dir_fn, topdown=False):
-        fns += [os.path.join(root, fn) for fn in files if fn.split(".")[-1] == ext]
+        fns += [os.path.join(root, fn) for fn in files if ext is None or fn.split(".")[-1] == ext]
     return fns
 
 ###########################################
@@ -40,11 +48,15 @@ class CsvDataReader:
 
     def __iter__(self):
         for fn in self.fns:
-            with open(fn) as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    yield row
-                f.close()
+            for row in self.iter_file(fn):
+                yield row
+
+    def iter_file(self, fn):
+        with open(fn) as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield row
+            f.close()
 
 
 ###########################################
@@ -56,29 +68,104 @@ class JsonDataReader:
     Expectation for these files is that 
     each individual line in the file is a
     json-serialized document
+
+    Files may be compressed (.json.gz, .json.bz2
+    or .json.xz), see compression.py
+
+    If fields is given, documents only keep those keys.
+    Where a file has an up-to-date fields sidecar (see
+    write_fields_sidecar) covering all of them, the much
+    smaller sidecar is read instead, so unused keys (e.g.
+    email bodies) are never decoded.
     """
 
-    def __init__(self, json_fn):
-        self.fns = _get_fns_from_dir(json_fn, "json")
+    def __init__(self, json_fn, fields=None):
+        if os.path.isdir(json_fn):
+            self.fns = [fn for fn in _get_fns_from_dir(json_fn, None)
+                            if strip_compression_ext(fn).split(".")[-1] == "json"]
+        else:
+            self.fns = [json_fn]
+        self.fields = fields
 
 
     def __iter__(self):
         for fn in self.fns:
-            with open(fn) as f:
-                for i,line in enumerate(f):
-                    d = json.loads(line)
+            for d in self.iter_file(fn):
+                yield d
+
+    def iter_file(self, fn):
+        if self.fields is not None:
+            sidecar_fn = get_fields_sidecar_fn(fn)
+            if _sidecar_covers(sidecar_fn, fn, self.fields):
+                for d in self._iter_sidecar(sidecar_fn):
                     yield d
-                f.close()
+                return
+        with open_text(fn) as f:
+            for i,line in enumerate(f):
+                d = json.loads(line)
+                if self.fields is not None:
+                    d = {k: d[k] for k in self.fields if k in d}
+                yield d
+            f.close()
+
+    def _iter_sidecar(self, sidecar_fn):
+        with open_text(sidecar_fn) as f:
+            next(f)
+            for line in f:
+                d = json.loads(line)
+                if len(d) > len(self.fields):
+                    d = {k: d[k] for k in self.fields if k in d}
+                yield d
+            f.close()
 
     @staticmethod
     def write(docs, out_fn):
-        with open(out_fn, 'w') as outf:
+        with open_text(out_fn, 'w') as outf:
             for d in docs:
                 outf.write(json.dumps(d) + "\n")
             outf.close()
 
 
 
+# A fields sidecar holds, for each document of a line-by-line
+# json file, just a few of its keys (e.g. the ones measure.py
+# needs), one json-serialized document per line after a header
+# line. It sits next to the json file, e.g. enron.json.fields
+# for enron.json or enron.json.fields.gz for enron.json.gz.
+SIDECAR_EXT = 'fields'
+SIDECAR_FORMAT = 'acculturation-fields'
+
+
+def get_fields_sidecar_fn(json_fn):
+    base = strip_compression_ext(json_fn)
+    return base + '.' + SIDECAR_EXT + json_fn[len(base):]
+
+
+def write_fields_sidecar(sidecar_fn, fields):
+    """
+    Opens a fields sidecar for writing and writes its header.
+    Write one json line per document (already projected onto
+    fields) to the returned file, and close it only after the
+    json file itself is closed: a sidecar older than its json
+    file is ignored as stale.
+    """
+    f = open_text(sidecar_fn, 'w')
+    f.write(json.dumps({"format": SIDECAR_FORMAT, "fields": list(fields)}) + "\n")
+    return f
+
+
+def _sidecar_covers(sidecar_fn, json_fn, fields):
+    try:
+        if os.path.getmtime(sidecar_fn) < os.path.getmtime(json_fn):
+            return False
+        with open_text(sidecar_fn) as f:
+            header = json.loads(f.readline())
+            f.close()
+    except (OSError, ValueError):
+        return False
+    return header.get("format") == SIDECAR_FORMAT and set(fields) <= set(header.get("fields", []))
+
+
 ###########################################
 
 
@@ -86,9 +173,13 @@ class JsonDataReader:
 
 class EmlDataReader:
 
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, workers=1, chunksize=64):
         self.base_dir = base_dir
-        self.fns = _get_fns_from_dir(base_dir, "eml")
+        # Sorted, so that which copy of a duplicated
+        # email is kept does not depend on the file system
+        self.fns = sorted(_get_fns_from_dir(base_dir, "eml"))
+        self.workers = workers
+        self.chunksize = chunksize
 
     def __iter__(self):
         """
@@ -96,56 +187,99 @@ class EmlDataReader:
         and subdirectories of self.base_dir.
         Does its best to parse each email before
         releasing.
+
+        If self.workers > 1, files are parsed in a
+        process pool, in chunks of self.chunksize files.
+        Documents are still released in file order, so
+        deduplication gives the same result either way:
+        the first file (in sorted path order) wins.
         """
 
         # Eml exports often include duplicate emails.
         # We will try to limit the duplicates we release
         msg_ids = set()
-        for fn in self.fns:
-            msg = mailparser.parse_from_file(fn)
-            if msg.message_id in msg_ids:
+        for msg_id, e in self._iter_parsed():
+            if msg_id in msg_ids:
                 continue
-            msg_ids.add(msg.message_id)
-            # Do our best to clean the msg body
-            body = self._clean_body(msg.body)
-            e = {
-                "message_id": msg.message_id,
-                # Keep only email addrs, not attempted parsed names
-                "from": msg.from_[0][1],
-                # Combine to and cc fields (i.e., no distinction made
-                #   between direct messages and group messages)
-                "to": [a[1] for a in msg.to] + [a[1] for a in msg.cc],
-                "date": str(msg.date),
-                "subject": msg.subject,
-                "body": body,
-                "attachments": [a['filename'] for a in msg.attachments]
-            }
+            msg_ids.add(msg_id)
             if not e['from'] or not e['to']:
                 continue
             yield e
 
-    # Regexes for some common quoted text beginnings
-    QUOTED_TXT_RES = [
+    def _iter_parsed(self):
+        # Yields (message_id, doc) for every message, in order
+        if self.workers > 1:
+            with multiprocessing.Pool(self.workers, initializer=_init_eml_worker, initargs=(self,)) as pool:
+                for parsed in imap_bounded(pool, _parse_eml_chunk,
+                                            iter_chunks(self._iter_sources(), self.chunksize),
+                                            max_pending=4*self.workers):
+                    for item in parsed:
+                        yield item
+        else:
+            for source in self._iter_sources():
+                msg = self._parse_source(source)
+                yield msg.message_id, self._msg_to_doc(msg)
+
+    def _iter_sources(self):
+        # Whatever _parse_source parses: here, .eml filenames
+        return iter(self.fns)
+
+    def _parse_source(self, source):
+        return mailparser.parse_from_file(source)
+
+    def iter_file(self, fn):
+        """
+        Parses a single .eml file, without deduplication
+        against other files
+        """
+        e = self._msg_to_doc(mailparser.parse_from_file(fn))
+        if e['from'] and e['to']:
+            yield e
+
+    def _msg_to_doc(self, msg):
+        # Do our best to clean the msg body
+        body = self._clean_body(msg.body)
+        e = {
+            "message_id": msg.message_id,
+            # Keep only email addrs, not attempted parsed names
+            "from": msg.from_[0][1],
+            # Combine to and cc fields (i.e., no distinction made
+            #   between direct messages and group messages)
+            "to": [a[1] for a in msg.to] + [a[1] for a in msg.cc],
+            "date": str(msg.date),
+            "subject": msg.subject,
+            "body": body,
+            "attachments": [a['filename'] for a in msg.attachments]
+        }
+        return e
+
+    # Regexes for some common quoted text beginnings, each with a
+    # literal that all its matches contain and how far into a match
+    # that literal can start at most (None if unbounded), so that
+    # bodies without the literal can skip the regex
+    # (see _find_quote_boundary)
+    QUOTED_TXT_PATTERNS = [
         ## With names & email addresses
-        re.compile(r"On (Mon|Tue|Wed|Thu|Fri|Sat|Sun|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday), (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9][,]? (at )?[0-9]+:[0-9][0-9][ ]?(A|P)M[,]? [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})(\n?)>[\s]?wrote:"),
-        re.compile(r"On (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9](,)? (at )?[0-9]+:[0-9][0-9] (AM|PM)?[ ]?[,]? [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})(\n?)>[\s]?wrote:"),
-        re.compile(r"On 201[0-9]-[0-9][0-9]-[0-9][0-9](,)? (at )?[0-2]?[0-9]:[0-9][0-9][ ]?, [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})[\n]?>[\s]wrote:"),
-        re.compile(r"On [0-9]?[0-9] (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) 201[0-9](,)? (at )?[0-9]+:[0-9][0-9][ ]?(AM|PM)?[ ]?[,]? [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})(\n?)>[\s]?wrote:"),
+        ("wrote:", None, r"On (Mon|Tue|Wed|Thu|Fri|Sat|Sun|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday), (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9][,]? (at )?[0-9]+:[0-9][0-9][ ]?(A|P)M[,]? [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})(\n?)>[\s]?wrote:"),
+        ("wrote:", None, r"On (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9](,)? (at )?[0-9]+:[0-9][0-9] (AM|PM)?[ ]?[,]? [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})(\n?)>[\s]?wrote:"),
+        ("On 201", 0, r"On 201[0-9]-[0-9][0-9]-[0-9][0-9](,)? (at )?[0-2]?[0-9]:[0-9][0-9][ ]?, [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})[\n]?>[\s]wrote:"),
+        ("wrote:", None, r"On [0-9]?[0-9] (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) 201[0-9](,)? (at )?[0-9]+:[0-9][0-9][ ]?(AM|PM)?[ ]?[,]? [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})(\n?)>[\s]?wrote:"),
         ## With names but no email addresses
-        re.compile(r"On (Mon|Tue|Wed|Thu|Fri|Sat|Sun|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday), (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9](,)? (at )?[0-9]+:[0-9][0-9] (A|P)M[ ]?[,]? [ a-zA-Z\.\-\"]+[\s]*wrote:"),
-        re.compile(r"On (Mon|Tue|Wed|Thu|Fri|Sat|Sun|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday), (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9][,]? [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})(\n?)>[\s]?wrote:"),
-        re.compile(r"On (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9](,)? (at )?[0-9]+:[0-9][0-9][ ]?(AM|PM)?[ ]?[,]?[ ]?[ a-zA-Z\.\-\"]+[\s]*wrote:"),
-        re.compile(r"On 201[0-9]-[0-9][0-9]-[0-9][0-9](,)? (at )?[0-2]?[0-9]:[0-9][0-9][ ]?,[ ]?[ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})[\n]?>[\s]wrote:"),
-        re.compile(r"On [0-9]?[0-9] (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) 201[0-9](,)? (at )?[0-9]+:[0-9][0-9][ ]?(AM|PM)?[ ]?[,]? [ a-zA-Z\.\-\"]+[\s]wrote:"),
+        ("wrote:", None, r"On (Mon|Tue|Wed|Thu|Fri|Sat|Sun|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday), (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9](,)? (at )?[0-9]+:[0-9][0-9] (A|P)M[ ]?[,]? [ a-zA-Z\.\-\"]+[\s]*wrote:"),
+        ("wrote:", None, r"On (Mon|Tue|Wed|Thu|Fri|Sat|Sun|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday), (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9][,]? [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})(\n?)>[\s]?wrote:"),
+        ("wrote:", None, r"On (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9](,)? (at )?[0-9]+:[0-9][0-9][ ]?(AM|PM)?[ ]?[,]?[ ]?[ a-zA-Z\.\-\"]+[\s]*wrote:"),
+        ("On 201", 0, r"On 201[0-9]-[0-9][0-9]-[0-9][0-9](,)? (at )?[0-2]?[0-9]:[0-9][0-9][ ]?,[ ]?[ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})[\n]?>[\s]wrote:"),
+        ("wrote:", None, r"On [0-9]?[0-9] (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) 201[0-9](,)? (at )?[0-9]+:[0-9][0-9][ ]?(AM|PM)?[ ]?[,]? [ a-zA-Z\.\-\"]+[\s]wrote:"),
         ## Different date format
-        re.compile(r"On [0-9]?[0-9]/[0-9]?[0-9]/201[0-9] (at )?[0-2]?[0-9]:[0-9][0-9][ ]?(AM|PM)?, [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})[\n]?>[\s]wrote:"),
-        re.compile(r"On [0-9]?[0-9]/[0-9]?[0-9]/201[0-9] (at )?[0-2]?[0-9]:[0-9][0-9][ ]?(AM|PM)?, [ a-zA-Z\.\-\"]+[\s]wrote:"),
+        ("wrote:", None, r"On [0-9]?[0-9]/[0-9]?[0-9]/201[0-9] (at )?[0-2]?[0-9]:[0-9][0-9][ ]?(AM|PM)?, [ a-zA-Z\.\-\"]+[\s]<[\n]?(?:[\w._%+-]+@[\w._%+-]+\.\w{2,})[\n]?>[\s]wrote:"),
+        ("wrote:", None, r"On [0-9]?[0-9]/[0-9]?[0-9]/201[0-9] (at )?[0-2]?[0-9]:[0-9][0-9][ ]?(AM|PM)?, [ a-zA-Z\.\-\"]+[\s]wrote:"),
         ## Other boundary markers
-        re.compile(r"----- Original [Mm]essage -----"),
-        re.compile(r"--- mail_boundary ---"),
-        re.compile(r"[Ss]ent from my (iPhone|Windows|Android|mobile)"),
-        re.compile(r"[Ss]ent: (Mon|Tue|Wed|Thu|Fri|Sat|Sun|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday)[,]? (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9](,)? (at )?[0-9]+:[0-9][0-9]"),
+        ("----- Original ", 0, r"----- Original [Mm]essage -----"),
+        ("--- mail_boundary ---", 0, r"--- mail_boundary ---"),
+        ("ent from my ", 1, r"[Ss]ent from my (iPhone|Windows|Android|mobile)"),
+        ("ent: ", 1, r"[Ss]ent: (Mon|Tue|Wed|Thu|Fri|Sat|Sun|Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday)[,]? (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec|January|February|March|April|May|June|July|August|September|October|November|December) [0-9]+, 201[0-9](,)? (at )?[0-9]+:[0-9][0-9]"),
     ]
+    QUOTED_TXT_RES = [re.compile(pattern) for _, _, pattern in QUOTED_TXT_PATTERNS]
 
     def _clean_body(self, body):
         """
@@ -164,27 +298,192 @@ class EmlDataReader:
 
         body = unidecode.unidecode(body)
         # Strip quoted text
-        for quot_re in self.QUOTED_TXT_RES:
-            body = quot_re.split(body)[0]
+        body = body[:self._find_quote_boundary(body)]
         # Try to remove inserted newlines
         # to recover intended paragraph splits--
         # rough and dirty style
         lines = body.split("\n")
         chunks = []
-        active_chunk = lines[0]
-        for i in range(1, len(lines)):
-            prev_line = lines[i-1]
-            curr_line = lines[i]
+        active_chunk = [lines[0]]
+        for prev_line, curr_line in zip(lines, lines[1:]):
             if len(prev_line) >= 65 and len(prev_line) <= 75:
                 # curr_line probably used to be part of prev_line
-                active_chunk += " " + curr_line
+                active_chunk.append(curr_line)
             else:
-                chunks.append(active_chunk)
-                active_chunk = curr_line
-        chunks.append(active_chunk)
+                chunks.append(" ".join(active_chunk))
+                active_chunk = [curr_line]
+        chunks.append(" ".join(active_chunk))
         body = "\n".join(chunks)
         body = body.replace("    ", " ")
         return body
 
+    def _find_quote_boundary(self, body):
+        """
+        Returns where quoted text starts in body (or len(body)).
+
+        This gives the same cut as splitting body on each of
+        QUOTED_TXT_RES in turn and keeping the first piece, without
+        splitting the whole body once per pattern. Every pattern has a
+        literal that all its matches contain (e.g. 'wrote:', listed
+        with it in QUOTED_TXT_PATTERNS), so
+        patterns whose literal is missing from body are skipped
+        after a substring test, and where the literal sits at a
+        bounded distance from the start of a match, no match can
+        start much before its first occurrence. The remaining
+        patterns are searched in turn, each only up to the earliest
+        boundary found so far.
+        """
+        candidates = []
+        start = len(body)
+        found = {}
+        for quot_re, (literal, max_offset, _) in zip(self.QUOTED_TXT_RES, self.QUOTED_TXT_PATTERNS):
+            # Many patterns share a literal; look each up once
+            pos = found.get(literal)
+            if pos is None:
+                pos = found[literal] = body.find(literal)
+            if pos < 0:
+                continue
+            candidates.append(quot_re)
+            start = min(start, 0 if max_offset is None else max(pos - max_offset, 0))
+        end = len(body)
+        for quot_re in candidates:
+            # Same as quot_re.search(body[:end]), without the copy
+            m = quot_re.search(body, start, end)
+            if m:
+                end = m.start()
+        return end
+
+
+###########################################
+
+
+TAR_EXTS = ('tar', 'tgz', 'tar.gz', 'tar.bz2', 'tar.xz')
+
+
+class RawEmailDataReader(EmlDataReader):
+
+    """
+    Shared logic for readers that stream raw messages out of
+    container files (mbox files, archives): subclasses set
+    self.fns to the container files and implement _iter_raw(fn),
+    which yields the raw bytes of each message in a file.
+
+    Cleaning, deduplication and workers are as for
+    EmlDataReader; messages are parsed in file order,
+    then in their order within each file.
+    """
+
+    def iter_file(self, fn):
+        """
+        Parses all messages of a single container file,
+        without deduplication
+        """
+        for raw in self._iter_raw(fn):
+            e = self._msg_to_doc(self._parse_source(raw))
+            if e['from'] and e['to']:
+                yield e
+
+    def _iter_sources(self):
+        for fn in self.fns:
+            for raw in self._iter_raw(fn):
+                yield raw
+
+    def _iter_raw(self, fn):
+        raise NotImplementedError
+
+    def _parse_source(self, source):
+        return mailparser.parse_from_bytes(source)
+
+
+class MboxDataReader(RawEmailDataReader):
+
+    """
+    Reads emails straight out of mbox files (a single
+    file, or all .mbox files in a directory and its
+    subdirectories), one message at a time.
+    """
+
+    def __init__(self, mbox_fn, workers=1, chunksize=64):
+        super().__init__(mbox_fn, workers=workers, chunksize=chunksize)
+        self.fns = sorted(_get_fns_from_dir(mbox_fn, "mbox"))
+
+    def _iter_raw(self, fn):
+        # Yields the raw bytes of each message, without the
+        # mbox 'From ' separator line
+        mbox = mailbox.mbox(fn, create=False)
+        try:
+            for key in mbox.iterkeys():
+                yield mbox.get_bytes(key)
+        finally:
+            mbox.close()
+
+
+class EmlArchiveDataReader(RawEmailDataReader):
+
+    """
+    Reads .eml files straight out of .zip and .tar
+    (optionally gzip, bz2 or xz compressed) archives,
+    without extracting them: archive_fn is a single
+    archive, or a directory whose archives are all read.
+    ZipDataReader and TarDataReader only accept one kind.
+
+    Members are read in archive order, and only members
+    ending in '.eml' are parsed.
+    """
+
+    ARCHIVE_EXTS = ('zip',) + TAR_EXTS
+
+    def __init__(self, archive_fn, workers=1, chunksize=64):
+        super().__init__(archive_fn, workers=workers, chunksize=chunksize)
+        if os.path.isdir(archive_fn):
+            self.fns = sorted(fn for fn in _get_fns_from_dir(archive_fn, None)
+                                if _has_ext(fn, self.ARCHIVE_EXTS))
+        elif _has_ext(archive_fn, self.ARCHIVE_EXTS):
+            self.fns = [archive_fn]
+        else:
+            raise ValueError("'%s' is not a %s archive" % (archive_fn, " or ".join(self.ARCHIVE_EXTS)))
+
+    def _iter_raw(self, fn):
+        # Yields the raw bytes of each .eml member
+        if _has_ext(fn, ('zip',)):
+            with zipfile.ZipFile(fn) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir() and info.filename.lower().endswith('.eml'):
+                        yield zf.read(info)
+        else:
+            # Stream mode: members are read sequentially,
+            # without seeking back through compressed data
+            with tarfile.open(fn, mode='r|*') as tf:
+                for member in tf:
+                    if member.isfile() and member.name.lower().endswith('.eml'):
+                        yield tf.extractfile(member).read()
+
+
+class ZipDataReader(EmlArchiveDataReader):
+
+    ARCHIVE_EXTS = ('zip',)
+
+
+class TarDataReader(EmlArchiveDataReader):
+
+    ARCHIVE_EXTS = TAR_EXTS
+
+
+def _has_ext(fn, exts):
+    fn = fn.lower()
+    return any(fn.endswith('.' + ext) for ext in exts)
+
+
+# Per-process reader for parsing .eml files in a pool
+_eml_worker = {}
 
+def _init_eml_worker(reader):
+    _eml_worker['reader'] = reader
 
+def _parse_eml_chunk(sources):
+    reader = _eml_worker['reader']
+    parsed = []
+    for source in sources:
+        msg = reader._parse_source(source)
+        parsed.append((msg.message_id, reader._msg_to_doc(msg)))
+    return parsed
@@ -4,10 +4,17 @@ import re
 import glob
 import sys
 import random
+import functools
+import multiprocessing
 from operator import itemgetter
 from collections import defaultdict, Counter
 import numpy as np
 
+from acculturation.aggregates import GroupAggregates, GroupReservoirSampler, get_aggregates
+from acculturation.columnar import ColumnarDataReader
+from acculturation.parallel import imap_bounded
+from acculturation.shards import ShardedDataReader
+
 
 ############
 
@@ -17,7 +24,12 @@ def measure_js_distances(documents, grouping_key,
                                     target_comparison_fnc=None,
                                     vocabsize=1000,
                                     sampling=False, sampsize=10000, 
+                                    seed=None,
                                     min_group_size=100,
+                                    return_matrix=False,
+                                    block_size=None,
+                                    streaming=False,
+                                    cache_dir=None,
                                     verbose=True):
     """
     Given iterator over individual documents, returns 
@@ -38,21 +50,78 @@ def measure_js_distances(documents, grouping_key,
     By default, all pairwise distances are measured.     
     If target_group is specified, only returns distances 
     between that and other groups.
+    If return_matrix is set, returns a dense distance matrix
+    instead (see pairwise_js_distances).
+
+    If sampling is set, each group is represented by a uniform
+    random sample of sampsize documents, drawn in a single pass with
+    at most sampsize documents held per group (see sample_documents).
+    Groups with fewer than sampsize documents are dropped. Set seed
+    for reproducible samples.
+
+    If streaming is set (and sampling is not), documents are not
+    held in memory: each document's term counts are added to
+    per-group sums as it is read (see aggregate_documents).
+    Note that this sums the actual counts in each document's
+    terms dict, whereas the default path counts each term once
+    per document it appears in.
+
+    If cache_dir is also set, the per-group sums are cached there
+    (see aggregates.get_aggregates), keyed on the input files and
+    grouping. Later runs over unchanged input, e.g. with another
+    min_group_size, target_group or vocabsize, skip the documents.
     """
 
+    if streaming and not sampling:
+        # Fold each document's counts into its groups' sums
+        # as it arrives, instead of keeping the documents
+        aggregates = get_aggregates(documents,
+                                        functools.partial(aggregate_documents,
+                                                            grouping_key=grouping_key,
+                                                            terms_key=terms_key,
+                                                            verbose=verbose),
+                                        ('group', grouping_key, terms_key),
+                                        cache_dir=cache_dir,
+                                        verbose=verbose)
+        return aggregate_js_distances(aggregates,
+                                        target_group=target_group,
+                                        target_comparison_fnc=target_comparison_fnc,
+                                        vocabsize=vocabsize,
+                                        min_group_size=min_group_size,
+                                        return_matrix=return_matrix,
+                                        block_size=block_size,
+                                        verbose=verbose)
+
+    if sampling:
+        # Keep a bounded random sample of each group's documents
+        # while they stream by (see sample_documents)
+        sampler = sample_documents(documents, grouping_key, sampsize,
+                                    terms_key=terms_key,
+                                    seed=seed,
+                                    verbose=verbose)
+        # Get rid of any buckets with insufficient docs
+        groups2docs = {}
+        for key in sorted(sampler.keys()):
+            if sampler.n_seen[key] < max(sampsize, min_group_size or 0):
+                if verbose:
+                    print("Too few messages for ", key)
+                continue
+            groups2docs[key] = sampler.samples[key]
+        dists = {key: get_term_count_distribution(docs, vocabsize=vocabsize)
+                    for key, docs in groups2docs.items()}
+        return pairwise_js_distances(dists,
+                                        target_group=target_group,
+                                        target_comparison_fnc=target_comparison_fnc,
+                                        return_matrix=return_matrix,
+                                        block_size=block_size,
+                                        verbose=verbose)
+
     # Put documents into buckets that we want to compare:
     groups2docs = defaultdict(list)
     for i, msg in enumerate(documents):
         if verbose:
             sys.stderr.write('\r') ; sys.stderr.write('msg %s' % i) ; sys.stderr.flush()
-        
-        # Get the groups the document belongs to
-        # Documents can belong to one or multiple groups
-        # so we accept both strings and a list of strings 
-        # as the grouping_key value
-        doc_group = msg[grouping_key]
-        doc_groups = doc_group if isinstance(doc_group, list) else [doc_group]
-        for gr in doc_groups:
+        for gr in get_document_groups(msg, grouping_key):
             # Keep only bag-of-words (or bag-of-lexicon categories) from msg
             groups2docs[gr].append(msg[terms_key])
 
@@ -68,65 +137,333 @@ def measure_js_distances(documents, grouping_key,
                     print("Too few messages for ", key)
                 del groups2docs[key]
 
-    # Reduce size of buckets, if desired:
-    if sampling:
-        # First get rid of any buckets with insufficient docs
-        groups = list(groups2docs.keys())
-        for key in groups:
-            if len(groups2docs[key]) < sampsize:
-                if verbose:
-                    print("Too few messages for ", key)
-                del groups2docs[key]
-        # Now randomly sample to bring each group to size
-        for key, messages in groups2docs.iteritems():
-            groups2docs[key] = random.sample(messages, sampsize)   
-
     # For each group, get count distribution over terms:
     dists = {}
     for key, docs in groups2docs.items():
         dists[key] = get_term_count_distribution(docs, vocabsize=vocabsize)
 
     # Now measure pairwise distances:
-    distances = {}
-    groups = sorted(groups2docs.keys())
+    return pairwise_js_distances(dists,
+                                    target_group=target_group,
+                                    target_comparison_fnc=target_comparison_fnc,
+                                    return_matrix=return_matrix,
+                                    block_size=block_size,
+                                    verbose=verbose)
+
+
+def pairwise_js_distances(dists, target_group=None,
+                                    target_comparison_fnc=None,
+                                    return_matrix=False,
+                                    block_size=None,
+                                    verbose=True):
+    """
+    Given a dictionary mapping groups to probability distributions
+    (as returned by get_term_count_distribution), measures JS
+    distances between groups.
+
+    All distributions are first aligned into one group x vocabulary
+    matrix, and distances are then computed block-by-block with
+    numpy (see js_distance_matrix) instead of once per pair.
+
+    Input args:
+        dists (dict) - maps each group to a {term: probability} dict
+        target_group (optional) - if set, only distances between
+            this group and all other groups are measured
+        target_comparison_fnc (optional fnc) - called with (g1, g2)
+            for each candidate pair; pairs for which it returns
+            False are skipped
+        return_matrix (bool) - if True, returns a tuple of
+            (row_groups, col_groups, matrix) where matrix is a dense
+            numpy array of distances. Skipped entries are nan.
+        block_size (int) - number of groups per block, defaults
+            to a size that keeps each block around 1M cells
+
+    Returns a dictionary of JS distances keyed on (g1, g2) tuples,
+    with both (g1, g2) and (g2, g1) filled in, unless
+    return_matrix is set.
+    """
+    groups = sorted(dists.keys())
 
     if verbose and len(groups) > 1:
         if not target_group:
             sys.stderr.write('Measuring pairwise distances for %d groups\n' % len(groups))
         else:
             sys.stderr.write('Measuring distances between "%s" and %d other groups\n' % (target_group, len(groups)-1))
-    
-    for i, g1 in enumerate(groups):
-        if verbose:
-            sys.stderr.write('\r') ; sys.stderr.write('group %s' % i) ; sys.stderr.flush()
-        for g2 in groups[i+1:]:
-            if target_group and target_group not in (g1, g2):
-                # We only care about one group and it's not here
+
+    vocab, P = build_distribution_matrix(dists, groups)
+
+    if target_group:
+        row_groups = [target_group] if target_group in dists else []
+        rows = P[[groups.index(g) for g in row_groups]]
+        matrix = js_distance_matrix(rows, P, block_size=block_size)
+    else:
+        row_groups = groups
+        matrix = js_distance_matrix(P, block_size=block_size)
+
+    if return_matrix:
+        if target_comparison_fnc:
+            for i, g1 in enumerate(row_groups):
+                for j, g2 in enumerate(groups):
+                    if g1 != g2 and not target_comparison_fnc(*sorted((g1, g2))):
+                        matrix[i, j] = np.nan
+        return row_groups, groups, matrix
+
+    distances = {}
+    for i, g1 in enumerate(row_groups):
+        # Visit each unordered pair once, in sorted order
+        cols = range(len(groups)) if target_group else range(i+1, len(groups))
+        for j in cols:
+            g2 = groups[j]
+            if g1 == g2:
                 continue
-            if target_comparison_fnc and not target_comparison_fnc(g1, g2):
+            pair = (g1, g2) if g1 < g2 else (g2, g1)
+            if target_comparison_fnc and not target_comparison_fnc(*pair):
                 # We asked the caller if they care about this 
                 # pair of groups and it turns out they don't
                 continue
-            js_dist = jensen_shannon(dists[g1], dists[g2])
-            distances[(g1, g2)] = js_dist
-            distances[(g2, g1)] = js_dist # Fill in symmetric
-    
+            js_dist = float(matrix[i, j])
+            distances[pair] = js_dist
+            distances[(pair[1], pair[0])] = js_dist # Fill in symmetric
+
+    return distances
+
+
+
+def aggregate_documents(documents, grouping_key, terms_key='terms',
+                                    aggregates=None, verbose=True):
+    """
+    Reads documents once, summing term counts and 
+    document counts per group. Memory is bounded by
+    groups x vocabulary rather than by the number of documents.
+
+    Sharded input (see shards.py) is aggregated shard by shard
+    in parallel, and the per-shard sums merged.
+
+    Returns a GroupAggregates (or updates the one passed in).
+    """
+    if aggregates is None:
+        aggregates = GroupAggregates()
+    if isinstance(documents, ShardedDataReader):
+        return aggregates.merge(documents.aggregate(
+                    functools.partial(aggregate_documents, grouping_key=grouping_key,
+                                        terms_key=terms_key, verbose=False)))
+    if isinstance(documents, ColumnarDataReader) and terms_key == documents.terms_key:
+        # Sum the count matrix directly
+        keys, sums, n_docs = documents.sum_counts_by_column(grouping_key)
+        return aggregates.merge(GroupAggregates.from_arrays(keys, documents.categories, sums, n_docs))
+    for i, msg in enumerate(documents):
+        if verbose:
+            sys.stderr.write('\r') ; sys.stderr.write('msg %s' % i) ; sys.stderr.flush()
+        for gr in get_document_groups(msg, grouping_key):
+            aggregates.add(gr, msg[terms_key])
     if verbose:
         sys.stderr.write('\n')
-    
+    return aggregates
+
+
+def aggregate_js_distances(aggregates,
+                                target_group=None,
+                                target_comparison_fnc=None,
+                                vocabsize=1000,
+                                min_group_size=100,
+                                return_matrix=False,
+                                block_size=None,
+                                verbose=True):
+    """
+    Returns JS distances between groups from their summed
+    term counts (e.g. from aggregate_documents), dropping
+    groups with fewer than min_group_size documents.
+    See measure_js_distances for the remaining arguments.
+    """
+    dists = aggregate_distributions(aggregates, vocabsize=vocabsize,
+                                        min_group_size=min_group_size, verbose=verbose)
+    return pairwise_js_distances(dists,
+                                    target_group=target_group,
+                                    target_comparison_fnc=target_comparison_fnc,
+                                    return_matrix=return_matrix,
+                                    block_size=block_size,
+                                    verbose=verbose)
+
+
+def aggregate_distributions(aggregates, vocabsize=1000, min_group_size=100, verbose=True):
+    """
+    Returns {group: {term: probability}} from summed term
+    counts, dropping groups with fewer than min_group_size
+    documents
+    """
+    groups = sorted(aggregates.keys())
+    if min_group_size:
+        for key in groups:
+            if aggregates.n_docs[key] < min_group_size:
+                if verbose:
+                    print("Too few messages for ", key)
+        groups = [key for key in groups if aggregates.n_docs[key] >= min_group_size]
+    return {key: get_count_distribution(aggregates.get_counts(key), vocabsize=vocabsize)
+                for key in groups}
+
+
+def iter_pairwise_js_distances(dists, target_comparison_fnc=None,
+                                    block_size=None,
+                                    workers=1,
+                                    verbose=True):
+    """
+    Streaming version of pairwise_js_distances for many groups:
+    yields (g1, g2, distance) once per pair of groups, with
+    g1 < g2, in the order pairwise_js_distances fills them in,
+    and with the same values.
+
+    Distances are computed in strips of block_size rows of the
+    upper triangle of the distance matrix (see js_distance_strip),
+    spread over workers processes, and yielded as each strip
+    is done, so only a few strips are held in memory at a time.
+    """
+    groups = sorted(dists.keys())
+    if verbose and len(groups) > 1:
+        sys.stderr.write('Measuring pairwise distances for %d groups\n' % len(groups))
+    vocab, P = build_distribution_matrix(dists, groups)
+    block_size = block_size or default_block_size(P.shape[1])
+    starts = range(0, len(groups), block_size)
+    if workers > 1 and len(starts) > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_strip_worker, initargs=(P, block_size))
+        strips = imap_bounded(pool, _strip_task, starts, max_pending=2*workers)
+    else:
+        pool = None
+        strips = (js_distance_strip(P, i0, block_size) for i0 in starts)
+    try:
+        for i0, strip in zip(starts, strips):
+            for r, row in enumerate(strip.tolist()):
+                i = i0 + r
+                g1 = groups[i]
+                for j in range(i+1, len(groups)):
+                    g2 = groups[j]
+                    if target_comparison_fnc and not target_comparison_fnc(g1, g2):
+                        continue
+                    yield g1, g2, row[j - i0]
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def js_distance_strip(P, i0, block_size=None):
+    """
+    Distances between rows i0:i0+block_size of P and rows i0:
+    of P, computed block by block as js_distance_matrix does.
+    Returns a (rows x len(P) - i0) matrix.
+    """
+    block_size = block_size or default_block_size(P.shape[1])
+    p = P[i0:i0+block_size]
+    out = np.zeros((p.shape[0], P.shape[0] - i0))
+    for j0 in range(i0, P.shape[0], block_size):
+        out[:, j0-i0:j0-i0+block_size] = _js_block(p, P[j0:j0+block_size])
+    return out
+
+
+# Per-process state for strip workers, set up once by _init_strip_worker
+_strip_worker = {}
+
+def _init_strip_worker(P, block_size):
+    _strip_worker['P'] = P
+    _strip_worker['block_size'] = block_size
+
+def _strip_task(i0):
+    return js_distance_strip(_strip_worker['P'], i0, _strip_worker['block_size'])
+
+
+def sample_documents(documents, grouping_key, sampsize,
+                                    terms_key='terms',
+                                    seed=None, verbose=True):
+    """
+    Reads documents once, keeping a uniform random sample of at
+    most sampsize terms dicts per group (reservoir sampling), along
+    with the number of documents each group saw.
+
+    Returns a GroupReservoirSampler.
+    """
+    sampler = GroupReservoirSampler(sampsize, seed=seed)
+    for i, msg in enumerate(documents):
+        if verbose:
+            sys.stderr.write('\r') ; sys.stderr.write('msg %s' % i) ; sys.stderr.flush()
+        for gr in get_document_groups(msg, grouping_key):
+            sampler.add(gr, msg[terms_key])
+    if verbose:
+        sys.stderr.write('\n')
+    return sampler
+
+
+def measure_aggregate_js_distances(aggregates, pairs, vocabsize=1000,
+                                    chunk_size=4096, vocab=None):
+    """
+    Measures JS distances between given pairs of groups
+    from summed term counts (see aggregates.GroupAggregates),
+    without revisiting any documents.
+
+    Input args:
+        aggregates (GroupAggregates) - per-group term counts
+        pairs (list) - list of (group1, group2) tuples
+        vocabsize (int) - per-group vocab size restriction,
+            as in get_term_count_distribution
+        vocab (list, optional) - sorted vocabulary to align
+            distributions on, defaults to the union vocabulary
+            of the groups in pairs. Distances come out bit for bit
+            the same for every pair measured on the same vocabulary
+            (see aggregate_vocabulary).
+
+    Returns a list of distances, aligned with pairs.
+    """
+    groups = sorted(set(g for pair in pairs for g in pair))
+    dists = {g: get_count_distribution(aggregates.get_counts(g), vocabsize=vocabsize)
+                for g in groups}
+    vocab, P = build_distribution_matrix(dists, groups, vocab=vocab)
+    g2i = {g: i for i, g in enumerate(groups)}
+    distances = []
+    for start in range(0, len(pairs), chunk_size):
+        chunk = pairs[start:start+chunk_size]
+        p = P[[g2i[g1] for g1, g2 in chunk]]
+        q = P[[g2i[g2] for g1, g2 in chunk]]
+        distances += js_distance_rows(p, q).tolist()
     return distances
 
 
+def aggregate_vocabulary(aggregates, groups, vocabsize=1000):
+    """
+    Returns the sorted union vocabulary of the given groups'
+    (vocabsize-restricted) distributions, i.e. the vocabulary
+    measure_aggregate_js_distances aligns pairs of them on.
+    """
+    return sorted(set(w for g in groups
+                        for w in get_count_distribution(aggregates.get_counts(g), vocabsize=vocabsize)))
+
+
 
 ######################################################################
 # General utilities        
 
 
+def get_document_groups(msg, grouping_key):
+    # Get the groups the document belongs to
+    # Documents can belong to one or multiple groups
+    # so we accept both strings and a list of strings 
+    # as the grouping_key value. A document counts once
+    # towards each of its groups, and documents with a null
+    # grouping_key value belong to no group (as in
+    # ColumnarDataReader.sum_counts_by_column). Documents
+    # without the grouping_key raise a KeyError, so that a
+    # mistyped key is not mistaken for an empty corpus
+    doc_group = msg[grouping_key]
+    if doc_group is None:
+        return []
+    if isinstance(doc_group, list):
+        return list(dict.fromkeys(doc_group))
+    return [doc_group]
+
 def get_term_count_distribution(messages, vocabsize=1000):
     # Flatten to a single list of words:
     words = [w for msg in messages for w in msg]
     # Create count dictionary:
     countdict = Counter(words)
+    return get_count_distribution(countdict, vocabsize=vocabsize)
+
+def get_count_distribution(countdict, vocabsize=1000):
     # Vocab size restriction based on frequency:
     countdict = dict(sorted(countdict.items(), key=itemgetter(1), reverse=True)[ : min(len(countdict), vocabsize)])
     # Distribution:
@@ -149,6 +486,80 @@ def jensen_shannon(f, g):
     b = 0.5 * kl(q, pq)
     return np.sqrt(a + b)
 
+def build_distribution_matrix(dists, groups=None, vocab=None):
+    """
+    Aligns {term: probability} dicts into a single
+    dense matrix with one row per group and one column
+    per term in the (sorted) union vocabulary, or in
+    vocab if given (which must cover all their terms).
+    Returns (vocab, matrix).
+    """
+    if groups is None:
+        groups = sorted(dists.keys())
+    if vocab is None:
+        vocab = sorted(set(w for g in groups for w in dists[g]))
+    w2i = {w: i for i, w in enumerate(vocab)}
+    matrix = np.zeros((len(groups), len(vocab)))
+    for i, g in enumerate(groups):
+        dist = dists[g]
+        matrix[i, [w2i[w] for w in dist]] = list(dist.values())
+    return vocab, matrix
+
+def js_distance_matrix(P, Q=None, block_size=None):
+    """
+    Jensen-Shannon distances between every row of P and
+    every row of Q (or between all rows of P, if Q is None).
+    Rows are expected to be aligned probability distributions.
+    """
+    symmetric = Q is None
+    if symmetric:
+        Q = P
+    out = np.zeros((P.shape[0], Q.shape[0]))
+    for i0, j0, block in iter_js_distance_blocks(P, Q, block_size=block_size,
+                                                        upper=symmetric):
+        out[i0:i0+block.shape[0], j0:j0+block.shape[1]] = block
+        if symmetric and i0 != j0:
+            out[j0:j0+block.shape[1], i0:i0+block.shape[0]] = block.T
+    return out
+
+def iter_js_distance_blocks(P, Q, block_size=None, upper=False):
+    """
+    Yields (row_offset, col_offset, distances) for consecutive
+    blocks of the P x Q distance matrix. If upper is set, P and Q
+    are assumed to be the same matrix and blocks strictly below
+    the diagonal are skipped.
+    """
+    if not block_size:
+        block_size = default_block_size(P.shape[1])
+    for i0 in range(0, P.shape[0], block_size):
+        p = P[i0:i0+block_size]
+        for j0 in range(i0 if upper else 0, Q.shape[0], block_size):
+            q = Q[j0:j0+block_size]
+            yield i0, j0, _js_block(p, q)
+
+def default_block_size(vocabsize):
+    # Keep the (rows x cols x vocab) intermediates around 1M cells
+    return max(1, int(np.sqrt(2**20 / max(1, vocabsize))))
+
+def js_distance_rows(P, Q):
+    """
+    Jensen-Shannon distances between corresponding
+    rows of two aligned matrices.
+    """
+    return _js(P, Q)
+
+def _js_block(p, q):
+    # Broadcast to (len(p), len(q), vocab) and compute
+    # jensen_shannon for all pairs at once
+    return _js(p[:, None, :], q[None, :, :])
+
+def _js(p, q):
+    pq = (p + q) / 2.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = 0.5 * np.where(p > 0, p * np.log2(p / pq), 0.0).sum(axis=-1)
+        b = 0.5 * np.where(q > 0, q * np.log2(q / pq), 0.0).sum(axis=-1)
+    return np.sqrt(np.maximum(a + b, 0.0))
+
 def kl(p, q):
     return np.sum(p * safelog2(p/q))
 
@@ -1,8 +1,12 @@
 
 import os
 import csv
+import json
+import mmap
+import bisect
+import numpy as np
 
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from acculturation.stemmer import PorterStemmer
 
 """
@@ -29,30 +33,95 @@ is assumed to be a word stem, matching all words with
 the same stem. For example, given the word "privileg*",
 other words such as "privileges" and "privileged"
 will match the lexicon entry.
+Alternatively, with wildcard_mode='prefix', wildcard
+entries match every word that starts with the text 
+before the "*" (as in LIWC), using the longest matching
+entry. This is resolved with a prefix trie in time
+proportional to the word's length, without stemming.
 
 A sample lexicon CSV file can be found 
 at sample-data/sample-lexicon.csv.
 
+Since the same words come up over and over in
+real text, word lookups (including misses) are
+memoized in a bounded LRU cache (kept on the lexicon
+itself, so lexicons still pickle). The cache size
+can be set with the cache_size argument (None for
+unbounded, 0 to disable) and its hit/miss counts
+are available through CSVLexicon.cache_info().
+
+For large lexicons shared by many processes, a lexicon CSV
+can be compiled once into a compact binary file
+(see compile_lexicon), which CompiledLexicon memory-maps
+instead of parsing and stemming the CSV at every start:
+
+    python -m acculturation.lexicon -l lexicon.csv -o lexicon.lexc
+
 """
 
 stemmer = PorterStemmer()
 
 
-class CSVLexicon:
+class Lexicon:
 
-    def __init__(self, lex_fn, word_key='Word'):
-        if not os.path.exists(lex_fn):
-            print("Error: lexicon file '%s' not found." % lex_fn)
-        self.word_key = word_key
-        self.word2cat, self.stem2cat = self._load(lex_fn)
+    """
+    Shared word scoring logic. Subclasses set up
+    self.categories and their word tables, and implement
+    _lookup(w), which returns the list of categories for a word.
+
+    Internally, each category is identified by its position
+    in self.categories, so a text can be scored straight into
+    a fixed-length count vector (get_category_vector_from_words)
+    that lines up across documents.
+    """
+
+    def __init__(self, cache_size=100000):
+        self.cat2id = {c: i for i, c in enumerate(self.categories)}
+        self._cache_size = cache_size
+        self.cache_clear()
 
+    def _cached_lookup(self, w):
+        cache = self._cache
+        try:
+            ids = cache[w]
+        except KeyError:
+            self._misses += 1
+            ids = self._lookup_ids(w)
+            if self._cache_size != 0:
+                cache[w] = ids
+                if self._cache_size is not None and len(cache) > self._cache_size:
+                    # Evict the least recently used word
+                    cache.popitem(last=False)
+            return ids
+        self._hits += 1
+        cache.move_to_end(w)
+        return ids
 
     def get_categories_from_word(self, w):
-        if w in self.word2cat:
-            cats = self.word2cat[w]
-        else:
-            cats = self.stem2cat.get(stemmer.stem_word(w), [])
-        return cats
+        return [self.categories[i] for i in self._cached_lookup(w)]
+
+    def get_category_ids_from_word(self, w):
+        """
+        Returns a tuple of the ids of w's categories
+        """
+        return self._cached_lookup(w)
+
+    def cache_info(self):
+        """
+        Returns (hits, misses, maxsize, currsize)
+        for the word lookup cache.
+        """
+        return self._hits, self._misses, self._cache_size, len(self._cache)
+
+    def cache_clear(self):
+        self._cache = OrderedDict()
+        self._hits = self._misses = 0
+
+    def _lookup(self, w):
+        raise NotImplementedError
+
+    def _lookup_ids(self, w):
+        return tuple(self.cat2id[c] for c in self._lookup(w))
 
     def get_category_counts_from_words(self, words):
         cats = Counter()
@@ -64,12 +133,46 @@ class CSVLexicon:
         cats = [c for w in words for c in self.get_categories_from_word(w)]
         return cats
 
+    def get_category_vector_from_words(self, words):
+        """
+        Returns category counts for words as an integer
+        array of length len(self.categories).
+        """
+        lookup = self._cached_lookup
+        ids = [i for w in words for i in lookup(w)]
+        return np.bincount(np.array(ids, dtype=np.intp), minlength=len(self.categories))
+
+
+class CSVLexicon(Lexicon):
+
+    def __init__(self, lex_fn, word_key='Word', cache_size=100000,
+                        wildcard_mode='stem'):
+        if not os.path.exists(lex_fn):
+            print("Error: lexicon file '%s' not found." % lex_fn)
+        if wildcard_mode not in WILDCARD_MODES:
+            raise ValueError("wildcard_mode must be one of %s" % ", ".join(WILDCARD_MODES))
+        self.word_key = word_key
+        self.wildcard_mode = wildcard_mode
+        self.word2cat, self.stem2cat, self.prefix2cat, self.categories = self._load(lex_fn)
+        if wildcard_mode == 'prefix':
+            self.prefix_trie = build_prefix_trie(self.prefix2cat)
+        Lexicon.__init__(self, cache_size=cache_size)
+
+    def _lookup(self, w):
+        if w in self.word2cat:
+            cats = self.word2cat[w]
+        elif self.wildcard_mode == 'prefix':
+            cats = match_prefix_trie(self.prefix_trie, w) or []
+        else:
+            cats = self.stem2cat.get(stemmer.stem_word(w), [])
+        return cats
+
     def _load(self, fn):
         """
         Reads input csv to build mapping 
         from words and word stems to lexicon categories
         """
-        word2cat, stem2cat = defaultdict(list), defaultdict(list)
+        word2cat, stem2cat, prefix2cat = defaultdict(list), defaultdict(list), defaultdict(list)
         csvreader = csv.DictReader(open(fn))
         for row in csvreader:
             if self.word_key not in row:
@@ -80,11 +183,238 @@ class CSVLexicon:
                 # This entry should match all stems
                 stem = stemmer.stem_word(w)
                 stem2cat[stem] += cats
+                prefix2cat[w[:w.index("*")]] += cats
             else:
                 # Only matches exact word
                 word2cat[w] += cats
-        return word2cat, stem2cat
+        categories = [c for c in (csvreader.fieldnames or []) if c != self.word_key]
+        # Repeated entries for a word (or stem, or prefix) are merged,
+        # so each of its categories counts once, as in compile_lexicon
+        for table in (word2cat, stem2cat, prefix2cat):
+            for w, cats in table.items():
+                table[w] = list(dict.fromkeys(cats))
+        return word2cat, stem2cat, prefix2cat, categories
+
+
+class CompiledLexicon(Lexicon):
+
+    """
+    Loads a lexicon written by compile_lexicon.
+
+    The file is memory-mapped rather than read, so loading
+    takes milliseconds regardless of lexicon size and
+    processes forked from the same parent (or mapping the
+    same file) share its pages.
+    Word lookups binary-search the sorted word, stem
+    and prefix tables in place.
+
+    Pickling a CompiledLexicon (e.g. to send it to worker
+    processes) stores only its path and settings: the copy
+    maps lex_fn again, which must still exist.
+    """
+
+    def __init__(self, lex_fn, cache_size=100000, wildcard_mode='stem'):
+        if wildcard_mode not in WILDCARD_MODES:
+            raise ValueError("wildcard_mode must be one of %s" % ", ".join(WILDCARD_MODES))
+        self.lex_fn = lex_fn
+        self.wildcard_mode = wildcard_mode
+        with open(lex_fn, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(COMPILED_MAGIC)] != COMPILED_MAGIC:
+            raise ValueError("'%s' is not a compiled lexicon file" % lex_fn)
+        pos = len(COMPILED_MAGIC)
+        header_len = int(np.frombuffer(self._mm, dtype='<u4', count=1, offset=pos)[0])
+        pos += 4
+        header = json.loads(self._mm[pos:pos+header_len].decode('utf-8'))
+        self._data_start = _data_start(header_len)
+        self.categories = header['categories']
+        self._n_bytes = header['bitset_bytes']
+        self._words = self._map_table(header['tables']['words'])
+        self._stems = self._map_table(header['tables']['stems'])
+        self._prefixes = self._map_table(header['tables']['prefixes'])
+        Lexicon.__init__(self, cache_size=cache_size)
+
+    def __reduce__(self):
+        # The memory map cannot be pickled; map the file again
+        return (self.__class__, (self.lex_fn, self._cache_size, self.wildcard_mode))
+
+    def _map_table(self, spec):
+        n = spec['n']
+        start = self._data_start
+        offsets = np.frombuffer(self._mm, dtype='<u8', count=n+1, offset=start+spec['offsets'])
+        bitsets = np.frombuffer(self._mm, dtype=np.uint8, count=n*self._n_bytes,
+                                    offset=start+spec['bitsets']).reshape(n, self._n_bytes)
+        return _SortedKeys(self._mm, start+spec['keys'], offsets), bitsets
+
+    def _lookup(self, w):
+        return [self.categories[i] for i in self._lookup_ids(w)]
+
+    def _lookup_ids(self, w):
+        cats = self._find(self._words, w)
+        if cats is None and self.wildcard_mode == 'prefix':
+            # Longest matching prefix first
+            for end in range(len(w), -1, -1):
+                cats = self._find(self._prefixes, w[:end])
+                if cats is not None:
+                    break
+        elif cats is None:
+            cats = self._find(self._stems, stemmer.stem_word(w))
+        return cats or ()
+
+    def _find(self, table, key):
+        keys, bitsets = table
+        key = key.encode('utf-8')
+        i = bisect.bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            return None
+        bits = np.unpackbits(bitsets[i], bitorder='little')
+        return tuple(int(j) for j in np.flatnonzero(bits[:len(self.categories)]))
+
+
+class _SortedKeys:
+
+    # Read-only sequence view over the utf-8 keys
+    # of a compiled table, for use with bisect
+
+    def __init__(self, buf, start, offsets):
+        self.buf = buf
+        self.start = start
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.buf[self.start+int(self.offsets[i]):self.start+int(self.offsets[i+1])]
+
+
+######################################################################
+# Prefix matching for wildcard entries
+
+WILDCARD_MODES = ('stem', 'prefix')
+
+
+def build_prefix_trie(prefix2cat):
+    """
+    Builds a character trie (nested dicts) from a mapping
+    of wildcard prefixes to categories. A node's categories
+    are stored under the None key.
+    """
+    trie = {}
+    for prefix, cats in prefix2cat.items():
+        node = trie
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[None] = cats
+    return trie
+
+
+def match_prefix_trie(trie, w):
+    """
+    Returns the categories of the longest prefix
+    of w in the trie, or None if no prefix matches.
+    """
+    cats = trie.get(None)
+    node = trie
+    for ch in w:
+        node = node.get(ch)
+        if node is None:
+            break
+        cats = node.get(None, cats)
+    return cats
+
+
+######################################################################
+# Compiled lexicon files
+
+# A compiled lexicon file is laid out as:
+#   COMPILED_MAGIC
+#   uint32 length of the json header that follows
+#   json header: category names (in id order), the number of
+#       bytes per category bitset, and the byte offsets of
+#       each table's sections (relative to the data start)
+#   zero padding up to the next multiple of 8 (the data start)
+#   for each table ('words' for exact entries, 'stems' and
+#       'prefixes' for wildcard entries), sorted by utf-8 key:
+#       concatenated utf-8 keys,
+#       uint64 key offsets (n+1),
+#       one category bitset per key (bit i set = category i)
+# All integers are little-endian. Sections are 8-byte aligned.
+
+COMPILED_MAGIC = b'ACCLEX1\0'
+
+
+def compile_lexicon(lex_fn, out_fn, word_key='Word'):
+    """
+    Reads a lexicon CSV (see CSVLexicon) and writes it
+    to out_fn as a compiled lexicon that can be loaded
+    with CompiledLexicon. Repeated entries for the same
+    word are merged.
+    """
+    lex = CSVLexicon(lex_fn, word_key=word_key)
+    cat2id = {c: i for i, c in enumerate(lex.categories)}
+    n_bytes = max(1, (len(lex.categories) + 7) // 8)
+
+    sections = []
+    tables = {}
+    pos = 0
+    for name, word2cat in (('words', lex.word2cat), ('stems', lex.stem2cat),
+                            ('prefixes', lex.prefix2cat)):
+        keys = sorted(w.encode('utf-8') for w in word2cat)
+        offsets = np.zeros(len(keys) + 1, dtype='<u8')
+        offsets[1:] = np.cumsum([len(k) for k in keys])
+        bits = np.zeros((len(keys), n_bytes * 8), dtype=np.uint8)
+        for i, k in enumerate(keys):
+            bits[i, [cat2id[c] for c in word2cat[k.decode('utf-8')]]] = 1
+        bitsets = np.packbits(bits, axis=1, bitorder='little')
+        spec = {'n': len(keys)}
+        for section, data in (('keys', b''.join(keys)),
+                                ('offsets', offsets.tobytes()),
+                                ('bitsets', bitsets.tobytes())):
+            spec[section] = pos
+            data += b'\0' * (-len(data) % 8)
+            sections.append(data)
+            pos += len(data)
+        tables[name] = spec
+
+    header = {'categories': lex.categories, 'bitset_bytes': n_bytes, 'tables': tables}
+    header_bytes = json.dumps(header).encode('utf-8')
+    with open(out_fn, 'wb') as outf:
+        outf.write(COMPILED_MAGIC)
+        outf.write(np.array([len(header_bytes)], dtype='<u4').tobytes())
+        outf.write(header_bytes)
+        # Pad so that the data sections start 8-byte aligned
+        outf.write(b'\0' * (_data_start(len(header_bytes)) - outf.tell()))
+        for data in sections:
+            outf.write(data)
+        outf.close()
+
+
+def _data_start(header_len):
+    pos = len(COMPILED_MAGIC) + 4 + header_len
+    return pos + (-pos % 8)
+
+
+def load_lexicon(lex_fn, **kwargs):
+    """
+    Loads a compiled lexicon if lex_fn is one,
+    otherwise reads it as a lexicon CSV.
+    """
+    with open(lex_fn, 'rb') as f:
+        is_compiled = f.read(len(COMPILED_MAGIC)) == COMPILED_MAGIC
+    if is_compiled:
+        return CompiledLexicon(lex_fn, **kwargs)
+    return CSVLexicon(lex_fn, **kwargs)
+
 
+if __name__ == "__main__":
 
+    import argparse
 
+    parser = argparse.ArgumentParser(description="Compile a lexicon CSV into a binary lexicon file that loads quickly via memory-mapping.")
+    parser.add_argument("-l", "--lexfn", type=str, action="store", dest="lex_fn", help="Lexicon CSV filename", required=True)
+    parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for the compiled lexicon", required=True)
+    parser.add_argument("-w", "--wordkey", type=str, action="store", dest="word_key", help="Lexicon CSV column holding words", default="Word")
+    args = parser.parse_args()
 
+    compile_lexicon(args.lex_fn, args.out_fn, word_key=args.word_key)
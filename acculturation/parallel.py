@@ -0,0 +1,50 @@
+import itertools
+from collections import deque
+
+"""
+Helpers for spreading work over a multiprocessing pool.
+
+Pool.imap reads its whole input iterable ahead of the
+workers, which for a large corpus means holding most of
+it in memory. imap_bounded instead keeps only a bounded
+number of tasks in flight.
+"""
+
+
+def iter_chunks(items, chunksize):
+    """
+    Groups any iterable into lists of up to chunksize items
+    """
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def imap_bounded(pool, fnc, tasks, max_pending, ordered=True):
+    """
+    Applies fnc to each task on pool and yields results,
+    with at most max_pending tasks submitted at a time.
+    If ordered is False, results are yielded as soon
+    as they are ready rather than in input order.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(fnc, (task,)))
+        while len(pending) >= max_pending:
+            yield _pop_result(pending, ordered)
+    while pending:
+        yield _pop_result(pending, ordered)
+
+
+def _pop_result(pending, ordered):
+    if ordered:
+        return pending.popleft().get()
+    while True:
+        for res in pending:
+            if res.ready():
+                pending.remove(res)
+                return res.get()
+        pending[0].wait(0.01)
@@ -1,9 +1,17 @@
 
+import os
+import sys
 import json
 import hashlib
-from collections import Counter
+import multiprocessing
+import numpy as np
 
-from acculturation.lexicon import CSVLexicon
+from acculturation.columnar import ColumnarCorpusWriter
+from acculturation.compression import open_text, compression_ext
+from acculturation.datareaders import get_fields_sidecar_fn, write_fields_sidecar
+from acculturation.lexicon import load_lexicon
+from acculturation.parallel import iter_chunks, imap_bounded
+from acculturation.shards import get_shard_fns, get_shard_manifest_fn, write_shard_manifest
 from acculturation.tokenizer import Tokenizer
 
 tokenizer = Tokenizer()
@@ -12,18 +20,30 @@ tokenizer = Tokenizer()
 def preprocess_docs(documents, lexicon_csv_fn, out_json_fn,
                         text_key="text",
                         cats_key="terms",
-                        custom_doc_fnc=None):
+                        custom_doc_fnc=None,
+                        wildcard_mode='stem',
+                        workers=1,
+                        ordered=True,
+                        chunksize=256,
+                        out_format='json',
+                        columns=('from', 'to', 'date'),
+                        sidecar_fields=None,
+                        shards=1):
     """
     Given iterator over individual documents,
     performs basic text preprocessing and saves
     preprocessed documents to disk via line-by-line JSON
+    (or as a columnar corpus, see columnar.py)
 
     Input args:
         documents (list or iterable) - iterable over documents,
             expected to be dictionary-like
-        lexicon_csv_fn (string) - filename of lexicon CSV.
+        lexicon_csv_fn (string) - filename of lexicon CSV
+            (or of a lexicon compiled with lexicon.compile_lexicon).
             For formatting requirements, see comments in lexicon.py
         out_json_fn (string) - filename of output file
+            (a directory for columnar output). JSON output is
+            compressed if out_json_fn ends in .gz, .bz2 or .xz
         text_key (string) - document key where text is stored
         cats_key (string) - document key where lexicon category
             counts will be stored
@@ -31,22 +51,344 @@ def preprocess_docs(documents, lexicon_csv_fn, out_json_fn,
             document manipulation function. Eg, for pruning
             documents before they're written to disk or
             adding grouping values
+        wildcard_mode (string) - how wildcard lexicon entries
+            are matched, 'stem' or 'prefix' (see lexicon.py)
+        workers (int) - number of processes to preprocess with.
+            If more than 1, documents are sent in chunks of
+            chunksize to a process pool, where each worker loads
+            the lexicon once. custom_doc_fnc must then be
+            picklable (e.g. a module-level function).
+        ordered (bool) - with workers > 1, whether output keeps
+            input order. Unordered output is written as soon as
+            any chunk is done, which can be faster.
+        out_format (string) - 'json' for line-by-line JSON, or
+            'columnar' for a columnar corpus directory, which
+            measure.py loads much faster. Columnar output keeps
+            only category counts and the given metadata columns.
+        columns (list) - document keys to keep as metadata
+            columns in columnar output (e.g. add group keys)
+        sidecar_fields (list) - with JSON output, also write
+            just these document keys to a fields sidecar next
+            to the output (see datareaders.JsonDataReader), which
+            readers that only need them load much faster
+        shards (int) - with JSON output, deal documents
+            round-robin over this many files plus a manifest
+            (see shards.py) instead of writing out_json_fn
 
     Returns: None
     """
-    lex = CSVLexicon(lexicon_csv_fn)
-    with open(out_json_fn, 'w') as outf:
-        for d in documents:
-            d[cats_key] = text_to_lexicon_categories(d[text_key], lex)
-            if custom_doc_fnc:
-                d = custom_doc_fnc(d)
-            outf.write(json.dumps(d) + "\n")
+    scored = iter_preprocessed_docs(documents, lexicon_csv_fn,
+                                        text_key=text_key,
+                                        cats_key=cats_key,
+                                        custom_doc_fnc=custom_doc_fnc,
+                                        wildcard_mode=wildcard_mode,
+                                        workers=workers,
+                                        ordered=ordered,
+                                        chunksize=chunksize,
+                                        to_json=(out_format == 'json'),
+                                        json_fields=sidecar_fields)
+    if shards > 1 and out_format != 'json':
+        raise ValueError("only json output can be sharded")
+    if out_format == 'columnar':
+        categories = load_lexicon(lexicon_csv_fn).categories
+        with ColumnarCorpusWriter(out_json_fn, categories, columns=columns,
+                                        terms_key=cats_key) as writer:
+            for d in scored:
+                writer.write(d)
+    elif out_format == 'json' and shards > 1:
+        shard_fns = get_shard_fns(out_json_fn, shards)
+        manifest_fn = get_shard_manifest_fn(out_json_fn)
+        if os.path.exists(manifest_fn):
+            os.remove(manifest_fn)
+        n_docs = _write_json_lines(scored, shard_fns, sidecar_fields)
+        write_shard_manifest(manifest_fn, shard_fns, n_docs)
+    elif out_format == 'json':
+        _write_json_lines(scored, [out_json_fn], sidecar_fields)
+    else:
+        raise ValueError("unsupported output format '%s'" % out_format)
+
+
+def _write_json_lines(lines, out_fns, sidecar_fields=None):
+    # Deals json lines round-robin over out_fns (lines are
+    # (line, sidecar line) pairs if sidecar_fields is set).
+    # Returns the number of lines written to each file.
+    outfs = [open_text(fn, 'w') for fn in out_fns]
+    sidecar_fns = [get_fields_sidecar_fn(fn) for fn in out_fns] if sidecar_fields else []
+    sidefs = [write_fields_sidecar(fn, sidecar_fields) for fn in sidecar_fns]
+    n_docs = [0] * len(out_fns)
+    try:
+        for i, line in enumerate(lines):
+            j = i % len(outfs)
+            if sidefs:
+                line, fields_line = line
+                sidefs[j].write(fields_line)
+            outfs[j].write(line)
+            n_docs[j] += 1
+    finally:
+        # Sidecars are closed after their outputs, so they are not stale
+        for f in outfs + sidefs:
+            f.close()
+    for fn in sidecar_fns:
+        os.utime(fn)
+    return n_docs
+
+
+def preprocess_docs_incremental(reader, lexicon_csv_fn, out_json_fn,
+                                    manifest_fn=None,
+                                    text_key="text",
+                                    cats_key="terms",
+                                    custom_doc_fnc=None,
+                                    wildcard_mode='stem',
+                                    commit_every=1000,
+                                    verbose=True):
+    """
+    Like preprocess_docs, but only processes input files that
+    are new or have changed since the last run, appending their
+    documents to the existing line-by-line JSON output.
+
+    A manifest (by default out_json_fn + '.manifest') records,
+    for every processed input file, its size, mtime and content
+    hash, the byte range its documents occupy in the output, and
+    their message ids (so duplicates of already-released emails
+    are skipped, as in EmlDataReader). It also records a fingerprint
+    of the lexicon and scoring settings: if those change, everything
+    is reprocessed. custom_doc_fnc is not part of the fingerprint.
+
+    Documents of changed or deleted input files are dropped from the
+    output before new documents are appended. The manifest is saved
+    every commit_every files; after a crash, the output is cut back
+    to the last saved state and the run simply picks up from there.
+
+    The output cannot be compressed, since documents are dropped
+    and appended by byte range.
+
+    Input args:
+        reader - a data reader with an fns list of input files
+            and an iter_file(fn) method (e.g. EmlDataReader)
+        (see preprocess_docs for the remaining arguments)
+
+    Returns: None
+    """
+    if compression_ext(out_json_fn):
+        raise ValueError("incremental output cannot be compressed: '%s'" % out_json_fn)
+    if manifest_fn is None:
+        manifest_fn = out_json_fn + MANIFEST_SUFFIX
+    fingerprint = _lexicon_fingerprint(lexicon_csv_fn, wildcard_mode, text_key, cats_key)
+    manifest = _load_manifest(manifest_fn)
+    if manifest is not None and (not os.path.exists(out_json_fn)
+                                    or os.path.getsize(out_json_fn) < manifest['output_bytes']):
+        # Output is missing or does not match the manifest
+        # (e.g. a crash while dropping stale documents)
+        manifest['fingerprint'] = None
+    if manifest is None or manifest['fingerprint'] != fingerprint:
+        if verbose and manifest is not None:
+            sys.stderr.write('Lexicon, settings or output changed: reprocessing all files\n')
+        manifest = {'fingerprint': fingerprint, 'output_bytes': 0, 'files': {}}
+        open(out_json_fn, 'w').close()
+    # Drop anything written after the last saved manifest
+    with open(out_json_fn, 'r+b') as outf:
+        outf.truncate(manifest['output_bytes'])
+        outf.close()
+
+    # Work out which input files are new, changed or gone
+    files = manifest['files']
+    todo = []
+    current = set()
+    for fn in sorted(reader.fns):
+        key = os.path.abspath(fn)
+        current.add(key)
+        st = os.stat(fn)
+        entry = files.get(key)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            continue
+        sha1 = _file_sha1(fn)
+        if entry and entry['sha1'] == sha1:
+            # Touched but not changed
+            entry['mtime'] = st.st_mtime
+            continue
+        todo.append((fn, key, st, sha1))
+    changed = set(key for _, key, _, _ in todo)
+    stale = [key for key in files if key not in current or key in changed]
+    if verbose:
+        sys.stderr.write('%d new or changed files, %d removed or replaced, %d unchanged\n'
+                            % (len(todo), len(stale), len(current) - len(todo)))
+    if stale:
+        for key in stale:
+            del files[key]
+        _compact_output(out_json_fn, files)
+        manifest['output_bytes'] = sum(e['end'] - e['start'] for e in files.values())
+    _save_manifest(manifest, manifest_fn)
+
+    lex = load_lexicon(lexicon_csv_fn, wildcard_mode=wildcard_mode)
+    seen_ids = set(i for e in files.values() for i in e.get('message_ids', []))
+    with open(out_json_fn, 'a') as outf:
+        for n, (fn, key, st, sha1) in enumerate(todo):
+            if verbose:
+                sys.stderr.write('\r') ; sys.stderr.write('file %s' % n) ; sys.stderr.flush()
+            start = manifest['output_bytes']
+            ids = []
+            for d in reader.iter_file(fn):
+                msg_id = d.get('message_id')
+                if msg_id is not None:
+                    if msg_id in seen_ids:
+                        continue
+                    seen_ids.add(msg_id)
+                    ids.append(msg_id)
+                line = _to_json_line(preprocess_doc(d, lex, text_key, cats_key, custom_doc_fnc))
+                outf.write(line)
+                manifest['output_bytes'] += len(line.encode('utf-8'))
+            files[key] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': sha1,
+                            'start': start, 'end': manifest['output_bytes']}
+            if ids:
+                files[key]['message_ids'] = ids
+            if (n + 1) % commit_every == 0:
+                outf.flush()
+                os.fsync(outf.fileno())
+                _save_manifest(manifest, manifest_fn)
+        outf.flush()
+        os.fsync(outf.fileno())
         outf.close()
+    _save_manifest(manifest, manifest_fn)
+    if verbose and todo:
+        sys.stderr.write('\n')
+
+
+MANIFEST_SUFFIX = '.manifest'
+
+
+def _lexicon_fingerprint(lexicon_fn, *settings):
+    return hashlib.sha1((_file_sha1(lexicon_fn) + json.dumps(settings)).encode('utf-8')).hexdigest()
+
+
+def _file_sha1(fn, bufsize=2**20):
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(bufsize), b''):
+            h.update(block)
+        f.close()
+    return h.hexdigest()
+
+
+def _load_manifest(manifest_fn):
+    if not os.path.exists(manifest_fn):
+        return None
+    with open(manifest_fn) as f:
+        manifest = json.load(f)
+        f.close()
+    return manifest
+
+
+def _save_manifest(manifest, manifest_fn):
+    # Write-then-rename so a crash never leaves a partial manifest
+    tmp_fn = manifest_fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+    os.replace(tmp_fn, manifest_fn)
+
+
+def _compact_output(out_fn, files, bufsize=2**20):
+    """
+    Rewrites out_fn keeping only the byte ranges of the given
+    manifest entries (in output order), and updates their ranges.
+    """
+    tmp_fn = out_fn + '.tmp'
+    pos = 0
+    with open(out_fn, 'rb') as src, open(tmp_fn, 'wb') as dst:
+        for entry in sorted(files.values(), key=lambda e: e['start']):
+            src.seek(entry['start'])
+            remaining = entry['end'] - entry['start']
+            while remaining:
+                block = src.read(min(bufsize, remaining))
+                dst.write(block)
+                remaining -= len(block)
+            entry['start'], entry['end'] = pos, pos + entry['end'] - entry['start']
+            pos = entry['end']
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_fn, out_fn)
+
+
+def iter_preprocessed_docs(documents, lexicon_fn,
+                                text_key="text",
+                                cats_key="terms",
+                                custom_doc_fnc=None,
+                                wildcard_mode='stem',
+                                workers=1,
+                                ordered=True,
+                                chunksize=256,
+                                to_json=False,
+                                json_fields=None):
+    """
+    Scores documents (see preprocess_docs for arguments)
+    and yields them, as json-serialized lines if to_json
+    is set, or otherwise as dictionaries. If json_fields
+    is also set, yields (line, line of just json_fields)
+    pairs.
+    """
+    if workers > 1:
+        init_args = (lexicon_fn, wildcard_mode, text_key, cats_key, custom_doc_fnc, to_json, json_fields)
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=init_args) as pool:
+            for chunk in imap_bounded(pool, _preprocess_chunk,
+                                        iter_chunks(documents, chunksize),
+                                        max_pending=4*workers,
+                                        ordered=ordered):
+                for out in chunk:
+                    yield out
+    else:
+        lex = load_lexicon(lexicon_fn, wildcard_mode=wildcard_mode)
+        for d in documents:
+            d = preprocess_doc(d, lex, text_key, cats_key, custom_doc_fnc)
+            yield _to_json_line(d, json_fields) if to_json else d
+
+
+def preprocess_doc(d, lex, text_key="text", cats_key="terms", custom_doc_fnc=None):
+    """
+    Scores a single document, adding its lexicon
+    category counts under cats_key
+    """
+    d[cats_key] = text_to_lexicon_categories(d[text_key], lex)
+    if custom_doc_fnc:
+        d = custom_doc_fnc(d)
+    return d
+
+
+def _to_json_line(d, fields=None):
+    line = json.dumps(d) + "\n"
+    if fields is None:
+        return line
+    return line, json.dumps({k: d[k] for k in fields if k in d}) + "\n"
+
+
+# Per-process state for pool workers, set up once by _init_worker
+_worker = {}
+
+def _init_worker(lexicon_fn, wildcard_mode, text_key, cats_key, custom_doc_fnc, to_json, json_fields):
+    _worker['lex'] = load_lexicon(lexicon_fn, wildcard_mode=wildcard_mode)
+    _worker['args'] = (text_key, cats_key, custom_doc_fnc)
+    _worker['to_json'] = to_json
+    _worker['json_fields'] = json_fields
+
+def _preprocess_chunk(docs):
+    docs = [preprocess_doc(d, _worker['lex'], *_worker['args']) for d in docs]
+    if _worker['to_json']:
+        # Serialize in the worker to keep the writing process light
+        return [_to_json_line(d, _worker['json_fields']) for d in docs]
+    return docs
 
 
 def text_to_lexicon_categories(txt, lex):
-    toks = tokenizer.tokenize(txt)
-    cats = lex.get_categories_from_words(toks)
-    cats = dict(Counter(cats))
+    counts = text_to_lexicon_vector(txt, lex)
+    cats = {lex.categories[i]: int(counts[i]) for i in np.flatnonzero(counts)}
     return cats
 
+
+def text_to_lexicon_vector(txt, lex):
+    """
+    Returns lexicon category counts for txt as a
+    vector aligned with lex.categories
+    """
+    toks = tokenizer.tokenize(txt)
+    return lex.get_category_vector_from_words(toks)
@@ -0,0 +1,227 @@
+import sys
+import multiprocessing
+import numpy as np
+
+from acculturation.jensen_shannon import js_distance_rows
+
+"""
+This file includes resampling estimates of how certain
+distances between groups are: bootstrap confidence intervals
+(resampling each group's documents with replacement) and
+permutation p-values (reassigning the two groups' pooled
+documents at random, keeping their sizes).
+
+Both work on a documents x terms count matrix: a replicate
+only changes how many times each document is counted
+towards each group, so a batch of replicates is a weights
+matrix, and their per-group sums a single matrix product.
+Every pair of groups gets its own random generator, spawned
+from one seed, so results do not depend on the number of
+worker processes.
+"""
+
+# Cells per (replicates x documents) weights matrix
+BATCH_CELLS = 2**22
+
+
+def document_count_matrix(documents, keys_fnc, terms_key='terms', verbose=True):
+    """
+    Reads documents once into a dense documents x terms
+    matrix of counts.
+
+    Input args:
+        documents - a data reader
+        keys_fnc (fnc) - returns the groups (or dyads, users, ...)
+            a document counts towards
+
+    Returns (terms, counts, members) where members maps
+    each group to the array of its documents' rows.
+    """
+    term2i = {}
+    members = {}
+    rows, cols, vals = [], [], []
+    n_docs = 0
+    for i, d in enumerate(documents):
+        if verbose:
+            sys.stderr.write('\r') ; sys.stderr.write('msg %s' % i) ; sys.stderr.flush()
+        keys = keys_fnc(d)
+        if not keys:
+            continue
+        for key in keys:
+            members.setdefault(key, []).append(n_docs)
+        for term, count in d[terms_key].items():
+            if term not in term2i:
+                term2i[term] = len(term2i)
+            rows.append(n_docs)
+            cols.append(term2i[term])
+            vals.append(count)
+        n_docs += 1
+    if verbose:
+        sys.stderr.write('\n')
+    terms = sorted(term2i)
+    order = np.array([term2i[t] for t in terms], dtype=np.int64)
+    col_map = np.empty(len(terms), dtype=np.int64)
+    col_map[order] = np.arange(len(terms))
+    counts = np.zeros((n_docs, len(terms)), dtype=np.int32)
+    if rows:
+        counts[np.array(rows), col_map[np.array(cols)]] = vals
+    members = {key: np.array(r, dtype=np.int64) for key, r in members.items()}
+    return terms, counts, members
+
+
+def group_sums(counts, members):
+    """
+    Returns (keys, sums, n_docs): each group's summed counts
+    (a groups x terms matrix) and number of documents
+    """
+    keys = list(members.keys())
+    sums = np.zeros((len(keys), counts.shape[1]), dtype=np.int64)
+    for i, key in enumerate(keys):
+        sums[i] = counts[members[key]].sum(axis=0)
+    n_docs = np.array([len(members[key]) for key in keys], dtype=np.int64)
+    return keys, sums, n_docs
+
+
+def resample_pair(counts_a, counts_b, rng, n_bootstrap=1000, n_permutations=1000,
+                            alpha=0.05, mask_a=None, mask_b=None, batch_cells=BATCH_CELLS):
+    """
+    Bootstrap and permutation estimates for the JS distance
+    between two groups' summed term counts.
+
+    Input args:
+        counts_a, counts_b (arrays) - documents x terms count
+            matrices of the two groups (on the same terms)
+        rng (numpy Generator) - source of randomness
+        n_bootstrap (int) - bootstrap replicates (0 to skip)
+        n_permutations (int) - permutation replicates (0 to skip)
+        alpha (float) - the confidence interval covers 1 - alpha
+        mask_a, mask_b (boolean arrays, optional) - terms kept
+            in each group's distribution (e.g. its vocabsize most
+            frequent ones, see term_mask); all terms by default
+
+    Returns (distance, ci_low, ci_high, p_value); the
+    interval is nan without bootstrap replicates and the
+    p-value is nan without permutation replicates.
+
+    The interval is the basic bootstrap interval
+    (2 * distance - upper quantile, 2 * distance - lower
+    quantile), clipped to [0, 1]. Plug-in JS distances are
+    biased upwards, and so are their bootstrap replicates;
+    reflecting the quantiles around the distance corrects for
+    that, so for small groups the interval tends to lie below
+    the distance rather than above it.
+    """
+    counts_a = np.asarray(counts_a, dtype=np.float64)
+    counts_b = np.asarray(counts_b, dtype=np.float64)
+    mask_a = 1.0 if mask_a is None else np.asarray(mask_a, dtype=np.float64)
+    mask_b = 1.0 if mask_b is None else np.asarray(mask_b, dtype=np.float64)
+    n_a, n_b = len(counts_a), len(counts_b)
+    sum_a, sum_b = counts_a.sum(axis=0), counts_b.sum(axis=0)
+    distance = float(_js_of_sums(sum_a[None, :] * mask_a, sum_b[None, :] * mask_b)[0])
+
+    ci_low = ci_high = np.nan
+    if n_bootstrap:
+        replicates = []
+        for b in _batches(n_bootstrap, n_a + n_b, batch_cells):
+            # How many times each document is drawn in each replicate
+            w_a = rng.multinomial(n_a, np.full(n_a, 1.0 / n_a), size=b)
+            w_b = rng.multinomial(n_b, np.full(n_b, 1.0 / n_b), size=b)
+            replicates.append(_js_of_sums((w_a @ counts_a) * mask_a, (w_b @ counts_b) * mask_b))
+        q_low, q_high = np.nanpercentile(np.concatenate(replicates), [50 * alpha, 100 - 50 * alpha])
+        ci_low = min(max(2 * distance - q_high, 0.0), 1.0)
+        ci_high = min(max(2 * distance - q_low, 0.0), 1.0)
+
+    p_value = np.nan
+    if n_permutations:
+        pooled = np.vstack([counts_a, counts_b])
+        total = sum_a + sum_b
+        n_extreme = 0
+        for b in _batches(n_permutations, n_a + n_b, batch_cells):
+            # The first n_a documents of a random order go to group a
+            order = np.argsort(rng.random((b, n_a + n_b)), axis=1)[:, :n_a]
+            in_a = np.zeros((b, n_a + n_b))
+            np.put_along_axis(in_a, order, 1.0, axis=1)
+            perm_a = in_a @ pooled
+            n_extreme += int(np.sum(_js_of_sums(perm_a * mask_a, (total - perm_a) * mask_b) >= distance))
+        p_value = (n_extreme + 1.0) / (n_permutations + 1.0)
+
+    return distance, float(ci_low), float(ci_high), float(p_value)
+
+
+def term_mask(terms, kept_terms):
+    """
+    Returns a boolean array marking which of terms
+    (as returned by document_count_matrix) are in kept_terms
+    """
+    kept_terms = set(kept_terms)
+    return np.array([t in kept_terms for t in terms], dtype=bool)
+
+
+def resample_distances(counts, members, pairs, n_bootstrap=1000, n_permutations=1000,
+                            alpha=0.05, masks=None, seed=None, workers=1, verbose=True):
+    """
+    Runs resample_pair for every (group1, group2) in pairs,
+    on the documents x terms counts matrix and members rows
+    returned by document_count_matrix, spreading pairs over
+    workers processes. masks optionally maps groups to the
+    terms kept in their distributions (see term_mask).
+
+    Yields (distance, ci_low, ci_high, p_value) per pair,
+    in order. Results are reproducible for a given seed.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(pairs))
+    tasks = [(pair, s) for pair, s in zip(pairs, seeds)]
+    options = (n_bootstrap, n_permutations, alpha)
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(counts, members, masks, options)) as pool:
+            for i, result in enumerate(pool.imap(_resample_task, tasks, chunksize=4)):
+                if verbose:
+                    sys.stderr.write('\r') ; sys.stderr.write('pair %s' % i) ; sys.stderr.flush()
+                yield result
+    else:
+        _init_worker(counts, members, masks, options)
+        for i, task in enumerate(tasks):
+            if verbose:
+                sys.stderr.write('\r') ; sys.stderr.write('pair %s' % i) ; sys.stderr.flush()
+            yield _resample_task(task)
+    if verbose:
+        sys.stderr.write('\n')
+
+
+def _js_of_sums(sums_a, sums_b):
+    # JS distances between rows of summed counts
+    # (rows without any counts are all-zero distributions,
+    # as in jensen_shannon.counts2dist)
+    return js_distance_rows(_normalize_rows(sums_a), _normalize_rows(sums_b))
+
+
+def _normalize_rows(sums):
+    totals = sums.sum(axis=1, keepdims=True)
+    return np.divide(sums, totals, out=np.zeros_like(sums), where=totals > 0)
+
+
+def _batches(n_replicates, n_docs, batch_cells):
+    # Splits n_replicates so each batch's weights fit in batch_cells
+    size = max(1, batch_cells // max(1, n_docs))
+    for start in range(0, n_replicates, size):
+        yield min(size, n_replicates - start)
+
+
+# Per-process state for pool workers, set up once by _init_worker
+_worker = {}
+
+def _init_worker(counts, members, masks, options):
+    _worker['counts'] = counts
+    _worker['members'] = members
+    _worker['masks'] = masks or {}
+    _worker['options'] = options
+
+def _resample_task(task):
+    (key_a, key_b), seed = task
+    counts, members, masks = _worker['counts'], _worker['members'], _worker['masks']
+    n_bootstrap, n_permutations, alpha = _worker['options']
+    return resample_pair(counts[members[key_a]], counts[members[key_b]],
+                            np.random.default_rng(seed),
+                            n_bootstrap=n_bootstrap, n_permutations=n_permutations, alpha=alpha,
+                            mask_a=masks.get(key_a), mask_b=masks.get(key_b))
@@ -0,0 +1,141 @@
+import os
+import json
+import multiprocessing
+
+from acculturation.aggregates import GroupAggregates
+from acculturation.compression import compression_ext, strip_compression_ext
+from acculturation.datareaders import JsonDataReader
+
+"""
+This file includes the sharded layout for preprocessed
+line-by-line JSON output (preprocess.py --shards N).
+
+Documents are dealt round-robin over N shard files next
+to the requested output name, e.g. for enron.json:
+    enron-00000-of-00004.json ... enron-00003-of-00004.json
+    enron.json.shards - a manifest listing the shard files
+        with their document counts and sizes in bytes.
+        Written last, so shards without one are incomplete.
+
+Shards are plain (or compressed) JSON files, so any
+JsonDataReader can read them; ShardedDataReader also
+aggregates them in parallel, one shard per task.
+"""
+
+SHARDS_SUFFIX = '.shards'
+SHARDS_FORMAT = 'acculturation-shards'
+
+
+def get_shard_fns(out_json_fn, n_shards):
+    """
+    Returns the shard filenames for output out_json_fn
+    """
+    ext = compression_ext(out_json_fn)
+    base = strip_compression_ext(out_json_fn)
+    if base.endswith('.json'):
+        base = base[:-len('.json')]
+    return ["%s-%05d-of-%05d.json%s" % (base, i, n_shards, '.' + ext if ext else '')
+                for i in range(n_shards)]
+
+
+def get_shard_manifest_fn(out_json_fn):
+    return out_json_fn + SHARDS_SUFFIX
+
+
+def write_shard_manifest(manifest_fn, shard_fns, n_docs):
+    """
+    Records shard files (relative to the manifest), with
+    their document counts and sizes, once they are complete
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_fn))
+    manifest = {
+        "format": SHARDS_FORMAT,
+        "n_docs": sum(n_docs),
+        "shards": [{"file": os.path.relpath(os.path.abspath(fn), base_dir),
+                    "n_docs": n,
+                    "bytes": os.path.getsize(fn)}
+                        for fn, n in zip(shard_fns, n_docs)]
+    }
+    tmp_fn = manifest_fn + ".tmp"
+    with open(tmp_fn, 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.close()
+    os.replace(tmp_fn, manifest_fn)
+
+
+def find_shard_manifest(path):
+    """
+    Returns the shard manifest for path (either the manifest
+    itself or the output name given to preprocess.py), or None
+    """
+    for fn in (path, get_shard_manifest_fn(path)):
+        if fn.endswith(SHARDS_SUFFIX) and os.path.isfile(fn):
+            return fn
+    return None
+
+
+class ShardedDataReader:
+
+    """
+    Reads sharded preprocessed output from its manifest.
+
+    Iterating yields all documents, shard by shard, like
+    JsonDataReader over the shard files would (fields
+    projection included). aggregate() instead folds each
+    shard into GroupAggregates in its own worker process
+    and merges the results.
+    """
+
+    def __init__(self, manifest_fn, fields=None, workers=1):
+        with open(manifest_fn) as f:
+            self.manifest = json.load(f)
+            f.close()
+        if self.manifest.get("format") != SHARDS_FORMAT:
+            raise ValueError("'%s' is not a shard manifest" % manifest_fn)
+        base_dir = os.path.dirname(os.path.abspath(manifest_fn))
+        self.fns = [os.path.join(base_dir, s["file"]) for s in self.manifest["shards"]]
+        self.n_docs = self.manifest["n_docs"]
+        self.fields = fields
+        self.workers = workers
+
+    def __len__(self):
+        return self.n_docs
+
+    def __iter__(self):
+        for fn in self.fns:
+            for d in self.iter_file(fn):
+                yield d
+
+    def iter_file(self, fn):
+        return JsonDataReader(fn, fields=self.fields).iter_file(fn)
+
+    def map_shards(self, fnc):
+        """
+        Yields fnc(reader) for a JsonDataReader over each
+        shard, in shard order. With workers > 1, shards are
+        read in a process pool, so fnc and its results must
+        be picklable (e.g. a functools.partial of a
+        module-level function).
+        """
+        tasks = [(fnc, fn, self.fields) for fn in self.fns]
+        if self.workers > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(min(self.workers, len(tasks))) as pool:
+                for result in pool.imap(_apply_to_shard, tasks):
+                    yield result
+        else:
+            for task in tasks:
+                yield _apply_to_shard(task)
+
+    def aggregate(self, fnc):
+        """
+        Merges the GroupAggregates fnc returns for each shard
+        """
+        aggregates = GroupAggregates()
+        for shard_aggregates in self.map_shards(fnc):
+            aggregates.merge(shard_aggregates)
+        return aggregates
+
+
+def _apply_to_shard(task):
+    fnc, fn, fields = task
+    return fnc(JsonDataReader(fn, fields=fields))
@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import datetime
+import functools
+from collections import defaultdict
+import numpy as np
+
+from acculturation.aggregates import GroupAggregates, _to_key
+from acculturation.shards import ShardedDataReader
+
+"""
+This file includes measurement over rolling time windows.
+
+Documents are read once and their term counts summed per
+day and group (see aggregate_days). Windows of consecutive
+days are then slid over those daily sums: each step adds the
+days that enter the window and subtracts the days that leave
+it, so a year of daily windows costs about one pass over the
+corpus plus two aggregate updates per day, instead of one
+pass per window.
+
+Per-day sums can also be kept as a DayIndex of cumulative
+sums, from which the sums over any date range (and so the
+distances within it) take two lookups per group.
+"""
+
+DAY_INDEX_FORMAT = 'acculturation-day-index'
+
+# Date ordinals stay below this (year 9999 is 3652059)
+_DAYS_PER_GROUP = 2**22
+
+
+def get_day(d, date_key='date'):
+    """
+    Returns the day of document d as an ISO 'YYYY-MM-DD'
+    string (as written by EmlDataReader, e.g. from
+    '2001-04-03 07:50:00+00:00'), or None if it has none
+    """
+    date = d.get(date_key)
+    if not date:
+        return None
+    day = str(date)[:10]
+    try:
+        datetime.date.fromisoformat(day)
+    except ValueError:
+        return None
+    return day
+
+
+def aggregate_days(documents, keys_fnc, terms_key='terms', date_key='date', verbose=True):
+    """
+    Reads documents once, summing term counts and document
+    counts per day and group. Documents without a date are
+    skipped. Sharded input is aggregated shard by shard in
+    parallel, as in aggregate_documents.
+
+    Input args:
+        documents - a data reader
+        keys_fnc (fnc) - returns the groups (or dyads, users, ...)
+            of a document. Must be picklable for sharded input.
+
+    Returns GroupAggregates keyed on (day, group).
+    """
+    if isinstance(documents, ShardedDataReader):
+        return documents.aggregate(functools.partial(aggregate_days, keys_fnc=keys_fnc,
+                                        terms_key=terms_key, date_key=date_key, verbose=False))
+    aggregates = GroupAggregates()
+    n_undated = 0
+    for i, d in enumerate(documents):
+        if verbose:
+            sys.stderr.write('\r') ; sys.stderr.write('msg %s' % i) ; sys.stderr.flush()
+        day = get_day(d, date_key)
+        if day is None:
+            n_undated += 1
+            continue
+        for key in keys_fnc(d):
+            aggregates.add((day, key), d[terms_key])
+    if verbose:
+        sys.stderr.write('\n')
+        if n_undated:
+            sys.stderr.write('Skipped %d documents without a date\n' % n_undated)
+    return aggregates
+
+
+def split_days(aggregates):
+    """
+    Splits GroupAggregates keyed on (day, group) into a
+    sorted list of (day, GroupAggregates keyed on group)
+    """
+    days = defaultdict(GroupAggregates)
+    for (day, key), n in aggregates.n_docs.items():
+        days[day].counts[key] = aggregates.counts[(day, key)]
+        days[day].n_docs[key] = n
+    return sorted(days.items())
+
+
+def iter_windows(days, window, step=1):
+    """
+    Slides a window over daily aggregates.
+
+    Input args:
+        days (list) - sorted (day, GroupAggregates) tuples,
+            as returned by split_days
+        window (int) - number of days per window
+        step (int) - number of days between window starts
+
+    Yields (first_day, last_day, aggregates) for windows
+    starting every step days from the first day with documents
+    until past the last one. aggregates is a single running
+    GroupAggregates, updated in place between windows by adding
+    the days that enter and subtracting the days that leave,
+    so it must be used (or copied) before the next window.
+    """
+    if window < 1 or step < 1:
+        raise ValueError("window and step must be at least one day")
+    if not days:
+        return
+    start = datetime.date.fromisoformat(days[0][0])
+    last = datetime.date.fromisoformat(days[-1][0])
+    running = GroupAggregates()
+    entering = leaving = 0
+    while start <= last:
+        end = start + datetime.timedelta(days=window)
+        start_day, end_day = start.isoformat(), end.isoformat()
+        while leaving < entering and days[leaving][0] < start_day:
+            running.subtract(days[leaving][1])
+            leaving += 1
+        if leaving == entering:
+            # Skip days between windows (when step > window)
+            while entering < len(days) and days[entering][0] < start_day:
+                entering += 1
+            leaving = entering
+        while entering < len(days) and days[entering][0] < end_day:
+            running.merge(days[entering][1])
+            entering += 1
+        yield start_day, (end - datetime.timedelta(days=1)).isoformat(), running
+        start += datetime.timedelta(days=step)
+
+
+class DayIndex:
+
+    """
+    Prefix sums of per-day term counts for every group, for
+    answering many date-range queries without rescanning the
+    corpus: the sums over any range of days come from two
+    lookups per group in the cumulative counts.
+
+    For each group (dyad, user, ...) only days with documents
+    are stored, so the index is as large as the per-day sums
+    it was built from (see aggregate_days):
+        days - the groups' days, as date ordinals, group by group
+        offsets - group i's rows are offsets[i]:offsets[i+1]
+        cum_counts - rows x categories cumulative term counts,
+            up to and including each row's day
+        cum_docs - cumulative document counts per row
+    """
+
+    def __init__(self, keys, categories, days, offsets, cum_counts, cum_docs, meta=None):
+        self.keys = keys
+        self.categories = categories
+        self.days = days
+        self.offsets = offsets
+        self.cum_counts = cum_counts
+        self.cum_docs = cum_docs
+        self.meta = meta or {}
+        self.key2i = {key: i for i, key in enumerate(keys)}
+        # (group, day) rows as one sorted array to search all groups at once
+        group_ids = np.repeat(np.arange(len(keys), dtype=np.int64), np.diff(offsets))
+        self._group_days = group_ids * _DAYS_PER_GROUP + days
+
+    @classmethod
+    def from_daily_aggregates(cls, aggregates, **meta):
+        """
+        Builds the index from GroupAggregates keyed on
+        (day, group), as returned by aggregate_days
+        """
+        keys = sorted(set(key for _, key in aggregates.keys()))
+        key2i = {key: i for i, key in enumerate(keys)}
+        categories = sorted(set(c for counts in aggregates.counts.values() for c in counts))
+        cat2i = {c: i for i, c in enumerate(categories)}
+        rows = sorted(aggregates.keys(), key=lambda k: (key2i[k[1]], k[0]))
+        days = np.array([datetime.date.fromisoformat(day).toordinal() for day, _ in rows], dtype=np.int64)
+        offsets = np.searchsorted(np.array([key2i[key] for _, key in rows], dtype=np.int64),
+                                    np.arange(len(keys) + 1))
+        counts = np.zeros((len(rows), len(categories)), dtype=np.int64)
+        for i, row in enumerate(rows):
+            for c, v in aggregates.counts[row].items():
+                counts[i, cat2i[c]] = v
+        n_docs = np.array([aggregates.n_docs[row] for row in rows], dtype=np.int64)
+        # Cumulative sums restart at each group's first row
+        cum_counts = np.cumsum(counts, axis=0)
+        cum_docs = np.cumsum(n_docs)
+        before = offsets[:-1] - 1
+        has_before = np.repeat(before >= 0, np.diff(offsets))
+        starts = np.repeat(before, np.diff(offsets))[has_before]
+        cum_counts[has_before] -= cum_counts[starts]
+        cum_docs[has_before] -= cum_docs[starts]
+        return cls(keys, categories, days, offsets, cum_counts, cum_docs, meta=meta)
+
+    def save(self, fn):
+        """
+        Saves the index to fn (an .npz file)
+        """
+        tmp_fn = fn + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            np.savez(f, keys=json.dumps(self.keys), categories=json.dumps(self.categories),
+                        days=self.days, offsets=self.offsets, cum_counts=self.cum_counts,
+                        cum_docs=self.cum_docs, meta=json.dumps(dict(self.meta, format=DAY_INDEX_FORMAT)))
+            f.close()
+        os.replace(tmp_fn, fn)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as saved:
+            meta = json.loads(str(saved['meta'])) if 'meta' in saved.files else {}
+            if meta.get("format") != DAY_INDEX_FORMAT:
+                raise ValueError("'%s' is not a day index" % fn)
+            return cls([_to_key(k) for k in json.loads(str(saved['keys']))],
+                        json.loads(str(saved['categories'])),
+                        saved['days'], saved['offsets'], saved['cum_counts'], saved['cum_docs'],
+                        meta=meta)
+
+    def range_sums(self, start, end, keys=None):
+        """
+        Sums term and document counts per group over the days
+        from start to end (ISO dates, both included).
+        Only groups in keys are considered, if given.
+        Returns (keys, sums, n_docs) for groups with documents
+        in the range. Raises ValueError if start is after end.
+        """
+        if keys is None:
+            ids = np.arange(len(self.keys), dtype=np.int64)
+        else:
+            ids = np.array([self.key2i[key] for key in keys if key in self.key2i], dtype=np.int64)
+        first = datetime.date.fromisoformat(start).toordinal()
+        last = datetime.date.fromisoformat(end).toordinal()
+        if first > last:
+            raise ValueError("range starts (%s) after it ends (%s)" % (start, end))
+        sums = self._cum_at(ids, last, self.cum_counts) - self._cum_at(ids, first - 1, self.cum_counts)
+        n_docs = self._cum_at(ids, last, self.cum_docs) - self._cum_at(ids, first - 1, self.cum_docs)
+        used = np.flatnonzero(n_docs)
+        return [self.keys[i] for i in ids[used].tolist()], sums[used], n_docs[used]
+
+    def range_aggregates(self, start, end, keys=None):
+        """
+        Returns GroupAggregates over the days from start to end,
+        as aggregating just those days' documents would
+        """
+        keys, sums, n_docs = self.range_sums(start, end, keys=keys)
+        return GroupAggregates.from_arrays(keys, self.categories, sums, n_docs)
+
+    def _cum_at(self, ids, day, cum):
+        # Cumulative values of groups ids up to and including day
+        # (zero for groups without documents by then)
+        rows = np.searchsorted(self._group_days, ids * _DAYS_PER_GROUP + day, side='right') - 1
+        found = rows >= self.offsets[ids]
+        values = cum[np.where(found, rows, 0)] if len(cum) else np.zeros((len(ids),) + cum.shape[1:], dtype=cum.dtype)
+        mask = found.reshape((-1,) + (1,) * (cum.ndim - 1))
+        return np.where(mask, values, 0)
@@ -0,0 +1,85 @@
+"""
+Checks and times EmlDataReader._clean_body against the
+original implementation, which split the body on each
+quoted-text regex in turn and rebuilt paragraphs by
+repeated string concatenation.
+
+Run from the repository root (requires mail-parser
+and unidecode):
+
+    python -m benchmarks.clean_body
+
+Exits with an error if any cleaned body differs from
+the original implementation's output.
+"""
+
+import sys
+import time
+
+import mailparser
+import unidecode
+
+from acculturation.datareaders import EmlDataReader
+
+
+def reference_clean_body(body):
+    # The original implementation, kept as the golden reference
+    body = unidecode.unidecode(body)
+    for quot_re in EmlDataReader.QUOTED_TXT_RES:
+        body = quot_re.split(body)[0]
+    lines = body.split("\n")
+    chunks = []
+    active_chunk = lines[0]
+    for i in range(1, len(lines)):
+        prev_line = lines[i-1]
+        curr_line = lines[i]
+        if len(prev_line) >= 65 and len(prev_line) <= 75:
+            active_chunk += " " + curr_line
+        else:
+            chunks.append(active_chunk)
+            active_chunk = curr_line
+    chunks.append(active_chunk)
+    body = "\n".join(chunks)
+    body = body.replace("    ", " ")
+    return body
+
+
+def time_fnc(fnc, bodies, repeat=20):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            fnc(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(eml_dir):
+    reader = EmlDataReader(eml_dir)
+    bodies = [mailparser.parse_from_file(fn).body for fn in reader.fns]
+    print("%d bodies (%d characters) from %s" % (len(bodies), sum(len(b) for b in bodies), eml_dir))
+
+    mismatches = [fn for fn, body in zip(reader.fns, bodies)
+                    if reader._clean_body(body) != reference_clean_body(body)]
+    if mismatches:
+        print("FAILED: %d bodies differ from the reference, e.g. %s" % (len(mismatches), mismatches[0]))
+        sys.exit(1)
+    print("all cleaned bodies identical to the reference")
+
+    ref = time_fnc(reference_clean_body, bodies)
+    new = time_fnc(reader._clean_body, bodies)
+    print("reference  %.3fs" % ref)
+    print("current    %.3fs" % new)
+    print("speedup: %.1fx" % (ref / new))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inputfn", type=str, action="store", dest="input_fn", help="Directory of .eml files", default="sample-data/enron")
+    args = parser.parse_args()
+
+    main(args.input_fn)
@@ -0,0 +1,62 @@
+"""
+Compares the stem-based and prefix-based handling of
+wildcard lexicon entries (see acculturation/lexicon.py)
+on the sample Enron corpus.
+
+Run from the repository root:
+
+    python -m benchmarks.lexicon_lookup
+
+Lookup caches are disabled so that every token
+pays the full cost of resolving a word.
+"""
+
+import time
+
+from acculturation.datareaders import CsvDataReader
+from acculturation.lexicon import CSVLexicon
+from acculturation.tokenizer import Tokenizer
+
+
+def time_lookups(lex, tokens, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for w in tokens:
+            lex.get_category_ids_from_word(w)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(corpus_fn, lex_fn, text_key='body'):
+    tokenizer = Tokenizer()
+    tokens = [w for d in CsvDataReader(corpus_fn) for w in tokenizer.tokenize(d[text_key])]
+    print("%d tokens (%d distinct) from %s" % (len(tokens), len(set(tokens)), corpus_fn))
+
+    lexicons = {mode: CSVLexicon(lex_fn, cache_size=0, wildcard_mode=mode)
+                    for mode in ('stem', 'prefix')}
+    timings = {}
+    for mode, lex in lexicons.items():
+        timings[mode] = time_lookups(lex, tokens)
+        print("%-6s  %.3fs  (%.2f us/token)" % (mode, timings[mode], 1e6 * timings[mode] / len(tokens)))
+    print("speedup: %.1fx" % (timings['stem'] / timings['prefix']))
+
+    # The two modes are different matching rules, so report where they disagree
+    differ = sorted(set(w for w in tokens
+                        if sorted(lexicons['stem'].get_categories_from_word(w))
+                            != sorted(lexicons['prefix'].get_categories_from_word(w))))
+    print("%d distinct tokens match differently, e.g. %s" % (len(differ), ", ".join(differ[:10])))
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inputfn", type=str, action="store", dest="input_fn", help="CSV corpus to tokenize", default="sample-data/enron.gender.csv")
+    parser.add_argument("-l", "--lexfn", type=str, action="store", dest="lex_fn", help="Lexicon CSV filename", default="sample-data/sample-lexicon.csv")
+    parser.add_argument("-t", "--textkey", type=str, action="store", dest="text_key", help="Key to access text of documents", default="body")
+    args = parser.parse_args()
+
+    main(args.input_fn, args.lex_fn, text_key=args.text_key)
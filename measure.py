@@ -1,14 +1,29 @@
 
+import os
+import sys
 import csv
+import functools
 
+from acculturation.aggregates import GroupAggregates, get_aggregates, save_aggregates, load_aggregates
+from acculturation.aggregates import aggregates_fingerprint
+from acculturation.columnar import ColumnarDataReader, is_columnar_corpus
 from acculturation.datareaders import JsonDataReader
-from acculturation.jensen_shannon import measure_js_distances
+from acculturation.jensen_shannon import measure_aggregate_js_distances
+from acculturation.jensen_shannon import aggregate_documents, aggregate_js_distances, aggregate_vocabulary
+from acculturation.jensen_shannon import get_document_groups, aggregate_distributions, iter_pairwise_js_distances
+from acculturation.jensen_shannon import get_count_distribution
+from acculturation.shards import ShardedDataReader, find_shard_manifest
+from acculturation.timeseries import aggregate_days, split_days, iter_windows, DayIndex
+from acculturation.resampling import document_count_matrix, group_sums, resample_distances, term_mask
 
 
 def measure_distances(input_fn, out_fn, comparison_type, 
                             group_key=None, 
                             min_group_size=0,
-                            terms_key='terms'):
+                            terms_key='terms',
+                            workers=1,
+                            cache_dir=None,
+                            upper=False):
     """
     This function assumes input documents are already preprocessed,
     json-serialized, and written line-by-line to input_fn (such as
@@ -33,111 +48,719 @@ def measure_distances(input_fn, out_fn, comparison_type,
         'to' key is expected to map to a user string whereas the 'from' key
         is expected to map to a list of user strings.
 
+    input_fn may also be a columnar corpus directory (see
+    acculturation/columnar.py), in which case per-group sums
+    are computed straight from its count matrix.
+
+    Only the document keys the comparison needs are loaded,
+    from fields sidecars where available (see JsonDataReader).
+
+    input_fn may also be sharded output (preprocess.py --shards),
+    given as its manifest or as the output name used for preprocess.py,
+    in which case shards are aggregated by up to workers processes.
+
+    If cache_dir is set, per-group sums are cached there, so that
+    later runs over the same unchanged input and comparison type
+    (e.g. with another min_group_size) skip reading documents.
+
+    Pairwise distances between groups are computed in blocks,
+    spread over workers processes (see
+    jensen_shannon.iter_pairwise_js_distances).
+
     Distances between groups are written as a CSV file to out_fn
+    as they are computed, for both orders of each pair, or only
+    once per pair (Group 1 < Group 2) if upper is set
     """
-    docs = JsonDataReader(input_fn)
+    fields, aggregate_fnc = get_comparison_aggregator(comparison_type, group_key, terms_key)
+    docs = open_corpus(input_fn, fields=fields, workers=workers)
     if comparison_type == "dyadic":
-        dists = measure_distances_dyadic(docs, min_group_size, terms_key=terms_key)
+        aggregates = get_aggregates(docs, aggregate_fnc, ('dyadic', terms_key), cache_dir=cache_dir)
+        rows = dyadic_distance_rows(aggregates, min_group_size)
     elif comparison_type == "individual-to-world":
-        dists = measure_distances_individual_to_world(docs, min_group_size, terms_key=terms_key)
-    elif comparison_type == "group-to-group":
+        aggregates = get_aggregates(docs, aggregate_fnc, ('individual-to-world', terms_key), cache_dir=cache_dir)
+        rows = individual_to_world_distance_rows(aggregates, min_group_size)
+    else:
+        aggregates = get_aggregates(docs, aggregate_fnc, ('group', group_key, terms_key), cache_dir=cache_dir)
+        dists = aggregate_distributions(aggregates, min_group_size=min_group_size)
+        rows = iter_pairwise_js_distances(dists, workers=workers)
+    write_distance_rows(rows, out_fn, upper=upper)
+
+
+def write_distances(dists, out_fn):
+    # Write distances to CSV
+    with open(out_fn, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Group 1", "Group 2", "Distance"])
+        for a,b in dists:
+            writer.writerow([a, b, dists[(a,b)]])
+        f.close()
+
+
+def write_distance_rows(rows, out_fn, upper=False):
+    """
+    Writes (a, b, distance) rows, one per pair, to CSV as they
+    come, in both orders like write_distances unless upper is set
+    """
+    with open(out_fn, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Group 1", "Group 2", "Distance"])
+        for a, b, js_dist in rows:
+            writer.writerow([a, b, js_dist])
+            if not upper:
+                writer.writerow([b, a, js_dist])
+        f.close()
+
+
+def measure_partial(input_fn, out_fn, comparison_type,
+                            group_key=None,
+                            terms_key='terms',
+                            workers=1):
+    """
+    Map step of a multi-machine measurement: sums term and
+    document counts per group (per dyad or per user, depending
+    on comparison_type) over input_fn, e.g. one shard of a
+    corpus, and saves them to out_fn (an .npz file).
+    Partial files are combined by measure_merge.
+
+    Input args are as for measure_distances.
+    """
+    fields, aggregate_fnc = get_comparison_aggregator(comparison_type, group_key, terms_key)
+    aggregates = aggregate_fnc(open_corpus(input_fn, fields=fields, workers=workers))
+    save_aggregates(aggregates, out_fn, type=comparison_type, group_key=group_key,
+                        terms_key=terms_key)
+
+
+def get_comparison_aggregator(comparison_type, group_key=None, terms_key='terms'):
+    """
+    Returns (fields, aggregate_fnc): the document keys a
+    comparison needs, and a function that sums a reader's
+    documents per group, dyad or user for it
+    """
+    if comparison_type == "group-to-group" and not group_key:
+        print("error: group_key must be set for group-to-group comparisons")
+        exit(1)
+    if comparison_type == "group-to-group":
+        fields = [terms_key, group_key]
+        aggregate_fnc = functools.partial(aggregate_documents, grouping_key=group_key, terms_key=terms_key)
+    elif comparison_type == "dyadic":
+        fields = [terms_key, 'from', 'to']
+        aggregate_fnc = functools.partial(aggregate_dyads, terms_key=terms_key)
+    elif comparison_type == "individual-to-world":
+        fields = [terms_key, 'from', 'to']
+        aggregate_fnc = functools.partial(aggregate_individual_to_world, terms_key=terms_key)
+    else:
+        print("error: unsupported comparison type '%s'" % comparison_type)
+        exit(1)
+    return fields, aggregate_fnc
+
+
+def measure_merge(partial_fns, out_fn, min_group_size=0, verbose=True):
+    """
+    Reduce step of a multi-machine measurement: adds up the
+    partial files written by measure_partial (which must all
+    be for the same comparison) and writes the distances
+    between groups as a CSV file to out_fn, as measure_distances
+    would have for all their inputs together.
+    """
+    aggregates = GroupAggregates()
+    spec = None
+    for fn in partial_fns:
+        if verbose:
+            sys.stderr.write('Merging %s\n' % fn)
+        partial, meta = load_aggregates(fn)
+        if spec is None:
+            spec = meta
+        elif meta != spec:
+            print("error: '%s' was made for a different comparison (%s) than '%s' (%s)"
+                    % (fn, meta, partial_fns[0], spec))
+            exit(1)
+        aggregates.merge(partial)
+    if spec is None or "type" not in spec:
+        print("error: no partial measurement files given")
+        exit(1)
+    if spec["type"] == "dyadic":
+        dists = dyadic_distances(aggregates, min_group_size, verbose=verbose)
+    elif spec["type"] == "individual-to-world":
+        dists = individual_to_world_distances(aggregates, min_group_size, verbose=verbose)
+    else:
+        dists = aggregate_js_distances(aggregates, min_group_size=min_group_size, verbose=verbose)
+    write_distances(dists, out_fn)
+
+
+def measure_delta(input_fn, state_fn, out_fn, comparison_type,
+                            group_key=None,
+                            min_group_size=0,
+                            terms_key='terms',
+                            workers=1,
+                            vocabsize=1000,
+                            verbose=True):
+    """
+    Incremental measurement: folds the documents in input_fn,
+    which must be new since the last run, into the per-group
+    sums kept in state_fn (an .npz file, created on the first
+    run) and writes the distances between groups over all
+    documents seen so far as a CSV file to out_fn.
+
+    Only pairs that involve a group (dyad or user) with new
+    documents are measured again; the other distances are
+    taken from state_fn. Distances are measured on the same
+    vocabulary as a full run would, so that out_fn is exactly
+    what measure_distances would write for all documents.
+    If that vocabulary, min_group_size or vocabsize changed
+    since the last run, all pairs are measured again.
+
+    state_fn also records the input files folded in so far
+    (by path, size and modification time), and input files
+    that were already folded in are refused.
+
+    Remaining input args are as for measure_distances.
+    """
+    fields, aggregate_fnc = get_comparison_aggregator(comparison_type, group_key, terms_key)
+    spec = {"type": comparison_type, "terms_key": terms_key}
+    if comparison_type == "group-to-group":
+        spec["group_key"] = group_key
+    aggregates, state = GroupAggregates(), None
+    if os.path.exists(state_fn):
+        aggregates, state = load_aggregates(state_fn)
+        state_spec = {k: state.get(k) for k in spec}
+        if state_spec != spec:
+            print("error: '%s' was made for a different comparison (%s)" % (state_fn, state_spec))
+            exit(1)
+    docs = open_corpus(input_fn, fields=fields, workers=workers)
+    # Input files are recognised by path, size and modification time
+    folded = state.get("inputs", []) if state else []
+    inputs = [aggregates_fingerprint([fn]) for fn in docs.fns]
+    for fn, fingerprint in zip(docs.fns, inputs):
+        if fingerprint in folded:
+            print("error: '%s' was already folded into '%s'" % (fn, state_fn))
+            exit(1)
+    new_aggregates = aggregate_fnc(docs)
+    aggregates.merge(new_aggregates)
+
+    if comparison_type == "dyadic":
+        pairs = dyadic_pairs(aggregates, min_group_size)
+        labels = [a for a, b in pairs]
+    elif comparison_type == "individual-to-world":
+        pairs = individual_to_world_pairs(aggregates, min_group_size)
+        labels = [(u, "world") for (_, u), _ in pairs]
+    else:
+        groups = sorted(key for key in aggregates.keys() if aggregates.n_docs[key] >= min_group_size)
+        pairs = [(g1, g2) for i, g1 in enumerate(groups) for g2 in groups[i+1:]]
+        labels = pairs
+    vocab = aggregate_vocabulary(aggregates, set(g for pair in pairs for g in pair),
+                                    vocabsize=vocabsize)
+
+    previous = {}
+    if state and (state["vocab"], state["min_group_size"], state["vocabsize"]) == (vocab, min_group_size, vocabsize):
+        previous = {(g1, g2): d for g1, g2, d in state["distances"]}
+    todo = [i for i, (g1, g2) in enumerate(pairs)
+                if g1 in new_aggregates or g2 in new_aggregates or labels[i] not in previous]
+    if verbose:
+        sys.stderr.write('Measuring distances for %d of %d pairs\n' % (len(todo), len(pairs)))
+    measured = measure_aggregate_js_distances(aggregates, [pairs[i] for i in todo],
+                                                vocabsize=vocabsize, vocab=vocab)
+    pair_dists = [previous.get(label) for label in labels]
+    for i, js_dist in zip(todo, measured):
+        pair_dists[i] = js_dist
+
+    dists = {}
+    for (a, b), js_dist in zip(labels, pair_dists):
+        dists[(a, b)] = js_dist
+        dists[(b, a)] = js_dist
+    write_distances(dists, out_fn)
+    save_aggregates(aggregates, state_fn, min_group_size=min_group_size, vocabsize=vocabsize,
+                        vocab=vocab, distances=[[a, b, d] for (a, b), d in zip(labels, pair_dists)],
+                        inputs=folded + inputs, **spec)
+
+
+def measure_rolling_distances(input_fn, out_fn, comparison_type, window,
+                            step=1,
+                            group_key=None,
+                            min_group_size=0,
+                            terms_key='terms',
+                            date_key='date',
+                            workers=1,
+                            cache_dir=None,
+                            verbose=True):
+    """
+    Time-series measurement: measures distances between groups
+    (or between each user and the world) within every window of
+    window days, starting every step days, from the documents'
+    date_key values (documents without one are skipped).
+
+    The corpus is read once, into per-day sums (cached in
+    cache_dir, if set), and windows are updated by adding the
+    days that enter and subtracting the days that leave
+    (see acculturation/timeseries.py).
+
+    Distances are written as a CSV file to out_fn, one row per
+    pair and window, as each window is measured. Remaining input
+    args are as for measure_distances.
+    """
+    if comparison_type not in ("group-to-group", "individual-to-world"):
+        print("error: rolling windows are supported for 'group-to-group' and 'individual-to-world' comparisons only")
+        exit(1)
+    aggregates = get_daily_aggregates(input_fn, comparison_type, group_key=group_key,
+                                        terms_key=terms_key, date_key=date_key,
+                                        workers=workers, cache_dir=cache_dir, verbose=verbose)
+    days = split_days(aggregates)
+    distances_fnc = functools.partial(get_distances_fnc(comparison_type), min_group_size=min_group_size,
+                                        verbose=False)
+
+    with open(out_fn, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Window start", "Window end", "Group 1", "Group 2", "Distance"])
+        for i, (first_day, last_day, window_aggregates) in enumerate(iter_windows(days, window, step=step)):
+            if verbose:
+                sys.stderr.write('\r') ; sys.stderr.write('window %s (%s)' % (i, first_day)) ; sys.stderr.flush()
+            dists = distances_fnc(window_aggregates)
+            for a,b in dists:
+                writer.writerow([first_day, last_day, a, b, dists[(a,b)]])
+        if verbose:
+            sys.stderr.write('\n')
+        f.close()
+
+
+def get_daily_aggregates(input_fn, comparison_type, group_key=None, terms_key='terms',
+                            date_key='date', workers=1, cache_dir=None, verbose=True):
+    """
+    Returns GroupAggregates of input_fn keyed on (day, group),
+    (day, dyad) or (day, user), depending on comparison_type
+    """
+    if comparison_type == "group-to-group":
         if not group_key:
             print("error: group_key must be set for group-to-group comparisons")
             exit(1)
-        dists = measure_js_distances(docs, group_key,
-                                        terms_key=terms_key,
-                                        min_group_size=min_group_size,
-                                        verbose=True)
+        fields = [terms_key, group_key, date_key]
+        keys_fnc = functools.partial(get_document_groups, grouping_key=group_key)
+    elif comparison_type == "dyadic":
+        fields = [terms_key, 'from', 'to', date_key]
+        keys_fnc = dyad_keys
+    elif comparison_type == "individual-to-world":
+        fields = [terms_key, 'from', 'to', date_key]
+        keys_fnc = individual_to_world_keys
     else:
         print("error: unsupported comparison type '%s'" % comparison_type)
         exit(1)
+    docs = open_corpus(input_fn, fields=fields, workers=workers)
+    return get_aggregates(docs,
+                            functools.partial(aggregate_days, keys_fnc=keys_fnc, terms_key=terms_key,
+                                                date_key=date_key, verbose=verbose),
+                            ('daily', comparison_type, group_key, terms_key, date_key),
+                            cache_dir=cache_dir, verbose=verbose)
+
+
+def get_distances_fnc(comparison_type):
+    """
+    Returns the function that measures distances for
+    comparison_type from its GroupAggregates
+    """
+    if comparison_type == "dyadic":
+        return dyadic_distances
+    if comparison_type == "individual-to-world":
+        return individual_to_world_distances
+    return aggregate_js_distances
+
+
+def build_day_index(input_fn, index_fn, comparison_type,
+                            group_key=None,
+                            terms_key='terms',
+                            date_key='date',
+                            workers=1,
+                            cache_dir=None):
+    """
+    Reads input_fn once and saves a DayIndex (see
+    acculturation/timeseries.py) of cumulative per-day sums
+    for comparison_type to index_fn (an .npz file), which
+    query_day_index answers date-range queries from.
+
+    Input args are as for measure_rolling_distances.
+    """
+    aggregates = get_daily_aggregates(input_fn, comparison_type, group_key=group_key,
+                                        terms_key=terms_key, date_key=date_key,
+                                        workers=workers, cache_dir=cache_dir)
+    index = DayIndex.from_daily_aggregates(aggregates, type=comparison_type, group_key=group_key,
+                                            terms_key=terms_key, date_key=date_key)
+    index.save(index_fn)
+    sys.stderr.write('Indexed %d groups over %d group-days\n' % (len(index.keys), len(index.days)))
+
+
+def query_day_index(index, start, end, groups=None, min_group_size=0):
+    """
+    Measures distances within the days from start to end
+    (ISO dates, both included) from a DayIndex, as
+    measure_distances would over just those days' documents.
+
+    Input args:
+        index (DayIndex) - e.g. DayIndex.load(index_fn)
+        start, end (str) - first and last day, e.g. '2001-01-31'
+        groups (list, optional) - only measure distances between
+            these groups (or for dyads between, or for,
+            these users)
+        min_group_size (int) - as for measure_distances
+
+    Returns a dictionary of distances keyed on (g1, g2) tuples.
+    """
+    comparison_type = index.meta.get("type")
+    keys = None
+    if groups is not None:
+        groups = set(groups)
+        if comparison_type == "dyadic":
+            keys = [(a, b) for a, b in index.keys if a in groups and b in groups]
+        elif comparison_type == "individual-to-world":
+            keys = [(kind, u) for kind, u in index.keys if u in groups]
+        else:
+            keys = [g for g in index.keys if g in groups]
+    aggregates = index.range_aggregates(start, end, keys=keys)
+    return get_distances_fnc(comparison_type)(aggregates, min_group_size=min_group_size, verbose=False)
+
+
+def measure_significance(input_fn, out_fn, comparison_type,
+                            group_key=None,
+                            min_group_size=0,
+                            terms_key='terms',
+                            n_bootstrap=1000,
+                            n_permutations=1000,
+                            alpha=0.05,
+                            seed=None,
+                            workers=1,
+                            vocabsize=1000,
+                            verbose=True):
+    """
+    Measures distances between groups along with a bootstrap
+    confidence interval and a permutation p-value for each pair
+    (see acculturation/resampling.py), resampling documents in
+    batched numpy operations, with pairs spread over workers
+    processes. Set seed for reproducible results.
+
+    Documents are held in memory as a documents x terms count
+    matrix. Distances are measured as measure_distances does,
+    and replicates keep the same vocabsize most frequent terms
+    of each group.
+
+    Writes a CSV file to out_fn with columns Group 1, Group 2,
+    Distance, CI low, CI high and p-value. The interval is the
+    basic bootstrap interval at level 1 - alpha (see
+    resampling.resample_pair), which corrects for the upward
+    bias of distances between small groups; for small groups
+    it can lie entirely below the distance itself.
+    Remaining input args are as for measure_distances.
+    """
+    if comparison_type == "group-to-group":
+        if not group_key:
+            print("error: group_key must be set for group-to-group comparisons")
+            exit(1)
+        fields = [terms_key, group_key]
+        keys_fnc = functools.partial(get_document_groups, grouping_key=group_key)
+    elif comparison_type == "dyadic":
+        fields = [terms_key, 'from', 'to']
+        keys_fnc = dyad_keys
+    elif comparison_type == "individual-to-world":
+        fields = [terms_key, 'from', 'to']
+        keys_fnc = individual_to_world_keys
+    else:
+        print("error: unsupported comparison type '%s'" % comparison_type)
+        exit(1)
+    docs = open_corpus(input_fn, fields=fields)
+    terms, counts, members = document_count_matrix(docs, keys_fnc, terms_key=terms_key, verbose=verbose)
+
+    keys, sums, n_docs = group_sums(counts, members)
+    aggregates = GroupAggregates.from_arrays(keys, terms, sums, n_docs)
+    if comparison_type == "dyadic":
+        pairs = dyadic_pairs(aggregates, min_group_size)
+        rows = dyadic_distance_rows(aggregates, min_group_size, vocabsize=vocabsize, verbose=False)
+    elif comparison_type == "individual-to-world":
+        pairs = individual_to_world_pairs(aggregates, min_group_size)
+        rows = individual_to_world_distance_rows(aggregates, min_group_size, vocabsize=vocabsize, verbose=False)
+    else:
+        dists = aggregate_distributions(aggregates, vocabsize=vocabsize,
+                                            min_group_size=min_group_size, verbose=False)
+        groups = sorted(dists.keys())
+        pairs = [(g1, g2) for i, g1 in enumerate(groups) for g2 in groups[i+1:]]
+        rows = iter_pairwise_js_distances(dists, workers=workers, verbose=False)
+    # Resample on the same vocabsize most frequent terms per group
+    masks = {key: term_mask(terms, get_count_distribution(aggregates.get_counts(key), vocabsize=vocabsize))
+                for key in set(g for pair in pairs for g in pair)}
+    if verbose:
+        sys.stderr.write('Resampling distances for %d pairs\n' % len(pairs))
 
-    # Write distances to CSV
     with open(out_fn, 'w') as f:
         writer = csv.writer(f)
-        writer.writerow(["Group 1", "Group 2", "Distance"])
-        for a,b in dists:
-            writer.writerow([a, b, dists[(a,b)]])
+        writer.writerow(["Group 1", "Group 2", "Distance", "CI low", "CI high", "p-value"])
+        results = resample_distances(counts, members, pairs, n_bootstrap=n_bootstrap,
+                                        n_permutations=n_permutations, alpha=alpha, masks=masks,
+                                        seed=seed, workers=workers, verbose=verbose)
+        for (a, b, js_dist), (_, ci_low, ci_high, p_value) in zip(rows, results):
+            writer.writerow([a, b, js_dist, ci_low, ci_high, p_value])
+            writer.writerow([b, a, js_dist, ci_low, ci_high, p_value])
         f.close()
 
 
-def measure_distances_dyadic(docs, min_group_size, terms_key='terms'):
+def open_corpus(input_fn, fields=None, workers=1):
+    """
+    Returns a reader over preprocessed documents,
+    either line-by-line json, sharded json or a columnar
+    corpus, optionally keeping only the given document keys
+    """
+    manifest_fn = find_shard_manifest(input_fn)
+    if manifest_fn:
+        return ShardedDataReader(manifest_fn, fields=fields, workers=workers)
+    if is_columnar_corpus(input_fn):
+        return ColumnarDataReader(input_fn, fields=fields)
+    return JsonDataReader(input_fn, fields=fields)
+
+
+def aggregate_dyads(docs, terms_key='terms', verbose=True):
+    """
+    Returns a GroupAggregates keyed on (sender, recipient)
+    """
+    if isinstance(docs, ShardedDataReader):
+        return docs.aggregate(functools.partial(aggregate_dyads, terms_key=terms_key, verbose=False))
+    if isinstance(docs, ColumnarDataReader) and terms_key == docs.terms_key:
+        keys, sums, n_docs = docs.sum_counts_by_dyad()
+        return GroupAggregates.from_arrays(keys, docs.categories, sums, n_docs)
 
-    # First, get set of users who sent messages
-    users = set()
-    for d in docs:
+    aggregates = GroupAggregates()
+    for i, d in enumerate(docs):
+        if verbose:
+            sys.stderr.write('\r') ; sys.stderr.write('msg %s' % i) ; sys.stderr.flush()
         if 'from' not in d:
             print("Error: documents must have 'from' key for dyadic comparisons")
             exit(1)
-        users.add(d['from'])
+        for recipient in get_recipients(d):
+            aggregates.add((d['from'], recipient), d[terms_key])
+    if verbose:
+        sys.stderr.write('\n')
+    return aggregates
 
-    # For each of these users, measure distances with interlocutors
-    dists = {}
-    for u in users:
-        udocs = [d for d in docs if u in get_users_involved(d)]
-        udists = measure_js_distances(udocs, 'from',
-                                    terms_key=terms_key,
-                                    target_group=u,
-                                    min_group_size=min_group_size,
-                                    verbose=True)
-        dists.update(udists)
 
+def dyadic_distances(aggregates, min_group_size, vocabsize=1000, verbose=True):
+    dists = {}
+    for a, b, js_dist in dyadic_distance_rows(aggregates, min_group_size,
+                                                vocabsize=vocabsize, verbose=verbose):
+        dists[(a, b)] = js_dist
+        dists[(b, a)] = js_dist
     return dists
 
 
-def measure_distances_individual_to_world(docs, min_group_size, terms_key='terms'):
+def dyadic_distance_rows(aggregates, min_group_size, vocabsize=1000, verbose=True):
+    """
+    Yields (a, b, distance) once per dyad, with a < b
+    """
+    pairs = dyadic_pairs(aggregates, min_group_size)
+
+    if verbose:
+        sys.stderr.write('Measuring distances for %d dyads\n' % len(pairs))
+    pair_dists = measure_aggregate_js_distances(aggregates, pairs, vocabsize=vocabsize)
+
+    for ((a, b), _), js_dist in zip(pairs, pair_dists):
+        yield a, b, js_dist
 
-    # First, get set of users who sent messages
-    users = set()
-    for d in docs:
-        if 'from' not in d:
+
+def dyadic_pairs(aggregates, min_group_size):
+    # Keep dyads with enough messages in both directions
+    pairs = []
+    for a, b in sorted(aggregates.keys()):
+        if a < b and (b, a) in aggregates:
+            if min(aggregates.n_docs[(a, b)], aggregates.n_docs[(b, a)]) >= min_group_size:
+                pairs.append(((a, b), (b, a)))
+    return pairs
+
+
+def aggregate_individual_to_world(docs, terms_key='terms', verbose=True):
+    """
+    Returns a GroupAggregates keyed on ('sent', user)
+    and ('received', user)
+    """
+    if isinstance(docs, ShardedDataReader):
+        return docs.aggregate(functools.partial(aggregate_individual_to_world,
+                                                    terms_key=terms_key, verbose=False))
+    if isinstance(docs, ColumnarDataReader) and terms_key == docs.terms_key:
+        keys, sums, n_docs = docs.sum_counts_by_user()
+        return GroupAggregates.from_arrays(keys, docs.categories, sums, n_docs)
+
+    aggregates = GroupAggregates()
+    for i, d in enumerate(docs):
+        if verbose:
+            sys.stderr.write('\r') ; sys.stderr.write('msg %s' % i) ; sys.stderr.flush()
+        if 'from' not in d or 'to' not in d:
             print("error: documents must have 'to' and 'from' keys for individual-to-world comparisons")
             exit(1)
-        users.add(d['from'])
+        aggregates.add(('sent', d['from']), d[terms_key])
+        for recipient in get_recipients(d):
+            aggregates.add(('received', recipient), d[terms_key])
+    if verbose:
+        sys.stderr.write('\n')
+    return aggregates
 
-    # For each of these users, measure distance between sent and received msgs
-    dists = {}
-    for u in users:
-        doc_grouping_fnc = get_individual_or_world_callback(u)
-        udocs = [d for d in docs if u in get_users_involved(d)]
-        udocs = [doc_grouping_fnc(d) for d in udocs]
-        udists = measure_js_distances(udocs, 'group',
-                                    terms_key=terms_key,
-                                    target_group=u,
-                                    min_group_size=min_group_size,
-                                    verbose=False)
-        dists.update(udists)
 
+def individual_to_world_distances(aggregates, min_group_size, vocabsize=1000, verbose=True):
+    dists = {}
+    for u, world, js_dist in individual_to_world_distance_rows(aggregates, min_group_size,
+                                                                vocabsize=vocabsize, verbose=verbose):
+        dists[(u, world)] = js_dist
+        dists[(world, u)] = js_dist
     return dists
 
 
-def get_individual_or_world_callback(user):
-    def individual_or_world_callback(d):
-        d['group'] = user if d['from'] == user else "world"
-        return d
-    return individual_or_world_callback
+def individual_to_world_distance_rows(aggregates, min_group_size, vocabsize=1000, verbose=True):
+    """
+    Yields (user, "world", distance) once per user
+    """
+    pairs = individual_to_world_pairs(aggregates, min_group_size)
+
+    if verbose:
+        sys.stderr.write('Measuring distances for %d users\n' % len(pairs))
+    pair_dists = measure_aggregate_js_distances(aggregates, pairs, vocabsize=vocabsize)
+
+    for ((_, u), _), js_dist in zip(pairs, pair_dists):
+        yield u, "world", js_dist
 
 
-def get_users_involved(d):
+def individual_to_world_pairs(aggregates, min_group_size):
+    # Keep users with enough sent and received messages
+    pairs = []
+    for kind, u in sorted(aggregates.keys()):
+        if kind == 'sent' and ('received', u) in aggregates:
+            if min(aggregates.n_docs[('sent', u)], aggregates.n_docs[('received', u)]) >= min_group_size:
+                pairs.append((('sent', u), ('received', u)))
+    return pairs
+
+
+def dyad_keys(d):
+    """
+    Returns the (sender, recipient) keys a document counts towards
+    """
+    if 'from' not in d:
+        print("Error: documents must have 'from' key for dyadic comparisons")
+        exit(1)
+    return [(d['from'], recipient) for recipient in get_recipients(d)]
+
+
+def individual_to_world_keys(d):
+    """
+    Returns the ('sent', user) and ('received', user)
+    keys a document counts towards
+    """
+    if 'from' not in d or 'to' not in d:
+        print("error: documents must have 'to' and 'from' keys for individual-to-world comparisons")
+        exit(1)
+    return [('sent', d['from'])] + [('received', recipient) for recipient in get_recipients(d)]
+
+
+def get_recipients(d):
+    """
+    Returns the set of users a document was sent to,
+    not counting the sender.
+    """
     to_users = d['to']
     if not isinstance(to_users, list):
         to_users = [to_users]
-    users = set(to_users)
-    users.add(d['from'])
-    return users
-
+    return set(to_users) - {d['from']}
 
 
 if __name__ == "__main__":
 
     import argparse
 
+    if len(sys.argv) > 1 and sys.argv[1] in ("partial", "merge", "delta", "index", "query"):
+        # Map/reduce measurement over many machines:
+        #   measure.py partial -i shard -o shard.npz -t TYPE (on each node)
+        #   measure.py merge -i *.npz -o distances.csv
+        # Incremental measurement as new documents come in:
+        #   measure.py delta -i new.json -s state.npz -o distances.csv -t TYPE
+        # Date-range queries:
+        #   measure.py index -i corpus.json -o index.npz -t TYPE
+        #   measure.py query -x index.npz -s 2001-01-01 -e 2001-03-31 -o distances.csv
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(dest="command")
+        partial_parser = subparsers.add_parser("partial", help="Sum counts per group over one input (e.g. one shard) and save them to a partial file")
+        partial_parser.add_argument("-i", "--inputfn", type=str, action="store", dest="input_fn", help="Filepath to preprocessed input data, as for measure.py", required=True)
+        partial_parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for the partial (.npz) file", required=True)
+        partial_parser.add_argument("-t", "--type", type=str, action="store", dest="type", help="Defines the grouping to use for measuring distances between groups. See readme for more detailed explanation.", choices=['dyadic', 'individual-to-world', 'group-to-group'], default="dyadic")
+        partial_parser.add_argument("-g", "--group_key", type=str, action="store", dest="group_key", help="Document key that sorts documents into groups. Only required for 'group-to-group' comparisons.")
+        partial_parser.add_argument("--workers", type=int, action="store", dest="workers", help="Number of processes to read shards of sharded input with (default: 1)", default=1)
+        merge_parser = subparsers.add_parser("merge", help="Add up partial files and write distances between groups")
+        merge_parser.add_argument("-i", "--inputfns", type=str, nargs="+", action="store", dest="input_fns", help="Partial files written by 'measure.py partial', all for the same comparison", required=True)
+        merge_parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for pairwise distances. Output will be written as a CSV file.", required=True)
+        merge_parser.add_argument("-n", "--n_min_group_size", type=int, action="store", dest="min_group_size", help="Minimum number of documents a group must have to be included in measurements", default=0)
+        delta_parser = subparsers.add_parser("delta", help="Fold new documents into a saved state and update distances between groups")
+        delta_parser.add_argument("-i", "--inputfn", type=str, action="store", dest="input_fn", help="Filepath to preprocessed documents that are new since the last run, as for measure.py", required=True)
+        delta_parser.add_argument("-s", "--state", type=str, action="store", dest="state_fn", help="State (.npz) file with per-group sums and distances of the previous runs. Created if it does not exist, and updated.", required=True)
+        delta_parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for pairwise distances over all documents so far. Output will be written as a CSV file.", required=True)
+        delta_parser.add_argument("-t", "--type", type=str, action="store", dest="type", help="Defines the grouping to use for measuring distances between groups. See readme for more detailed explanation.", choices=['dyadic', 'individual-to-world', 'group-to-group'], default="dyadic")
+        delta_parser.add_argument("-g", "--group_key", type=str, action="store", dest="group_key", help="Document key that sorts documents into groups. Only required for 'group-to-group' comparisons.")
+        delta_parser.add_argument("-n", "--n_min_group_size", type=int, action="store", dest="min_group_size", help="Minimum number of documents a group must have to be included in measurements", default=0)
+        delta_parser.add_argument("--workers", type=int, action="store", dest="workers", help="Number of processes to read shards of sharded input with (default: 1)", default=1)
+        index_parser = subparsers.add_parser("index", help="Build an index of cumulative per-day sums for date-range queries")
+        index_parser.add_argument("-i", "--inputfn", type=str, action="store", dest="input_fn", help="Filepath to preprocessed input data, as for measure.py", required=True)
+        index_parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for the index (.npz) file", required=True)
+        index_parser.add_argument("-t", "--type", type=str, action="store", dest="type", help="Defines the grouping to use for measuring distances between groups. See readme for more detailed explanation.", choices=['dyadic', 'individual-to-world', 'group-to-group'], default="dyadic")
+        index_parser.add_argument("-g", "--group_key", type=str, action="store", dest="group_key", help="Document key that sorts documents into groups. Only required for 'group-to-group' comparisons.")
+        index_parser.add_argument("--workers", type=int, action="store", dest="workers", help="Number of processes to read shards of sharded input with (default: 1)", default=1)
+        index_parser.add_argument("--cache", type=str, action="store", dest="cache_dir", help="Directory to cache per-day sums in, as for measure.py --cache")
+        query_parser = subparsers.add_parser("query", help="Measure distances between groups within a date range from an index")
+        query_parser.add_argument("-x", "--index", type=str, action="store", dest="index_fn", help="Index file written by 'measure.py index'", required=True)
+        query_parser.add_argument("-s", "--start", type=str, action="store", dest="start", help="First day of the range (YYYY-MM-DD)", required=True)
+        query_parser.add_argument("-e", "--end", type=str, action="store", dest="end", help="Last day of the range (YYYY-MM-DD), included", required=True)
+        query_parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for pairwise distances. Output will be written as a CSV file.", required=True)
+        query_parser.add_argument("--groups", type=str, nargs="+", action="store", dest="groups", help="Only measure distances between these groups (or, for dyadic and individual-to-world indexes, these users)")
+        query_parser.add_argument("-n", "--n_min_group_size", type=int, action="store", dest="min_group_size", help="Minimum number of documents a group must have (within the range) to be included in measurements", default=0)
+        args = parser.parse_args()
+
+        if args.command == "index":
+            build_day_index(args.input_fn, args.out_fn, args.type, group_key=args.group_key,
+                                workers=args.workers, cache_dir=args.cache_dir)
+        elif args.command == "query":
+            try:
+                index = DayIndex.load(args.index_fn)
+                dists = query_day_index(index, args.start, args.end, groups=args.groups,
+                                            min_group_size=args.min_group_size)
+            except ValueError as e:
+                print("error: %s" % e)
+                exit(1)
+            write_distances(dists, args.out_fn)
+        elif args.command == "partial":
+            measure_partial(args.input_fn, args.out_fn, args.type, group_key=args.group_key, workers=args.workers)
+        elif args.command == "delta":
+            measure_delta(args.input_fn, args.state_fn, args.out_fn, args.type, group_key=args.group_key,
+                            min_group_size=args.min_group_size, workers=args.workers)
+        else:
+            measure_merge(args.input_fns, args.out_fn, min_group_size=args.min_group_size)
+        exit(0)
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--inputfn", type=str, action="store", dest="input_fn", help="Filepath to input data. Documents must be preprocessed and stored in a file of line-by-line json-serialized documents, such as from output of preprocess.py. If filepath is a directory, all .json files in directory will be loaded.", required=True)
+    parser.add_argument("-i", "--inputfn", type=str, action="store", dest="input_fn", help="Filepath to input data. Documents must be preprocessed and stored in a file of line-by-line json-serialized documents, such as from output of preprocess.py. If filepath is a directory, all .json files in directory will be loaded, unless it is a columnar corpus written by preprocess.py --columnar.", required=True)
     parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for pairwise distances. Output will be written as a CSV file.", required=True)
     parser.add_argument("-t", "--type", type=str, action="store", dest="type", help="Defines the grouping to use for measuring distances between groups. See readme for more detailed explanation.", choices=['dyadic', 'individual-to-world', 'group-to-group'], default="dyadic")
     parser.add_argument("-g", "--group_key", type=str, action="store", dest="group_key", help="Document key that sorts documents into groups. Only required for 'group-to-group' comparisons.")
     parser.add_argument("-n", "--n_min_group_size", type=int, action="store", dest="min_group_size", help="Minimum number of documents a group must have to be included in measurements", default=0)
+    parser.add_argument("--workers", type=int, action="store", dest="workers", help="Number of processes to read shards of sharded input and to measure pairwise distances with (default: 1)", default=1)
+    parser.add_argument("--upper", action="store_true", dest="upper", help="Write each pair of groups once (Group 1 < Group 2) instead of in both orders")
+    parser.add_argument("--cache", type=str, action="store", dest="cache_dir", help="Directory to cache per-group sums in. Later runs over the same unchanged input and comparison (e.g. with another -n) reuse them instead of reading the documents again.")
+    parser.add_argument("--window", type=int, action="store", dest="window", help="Measure distances within rolling windows of this many days (by document date) instead of over the whole corpus. Only for 'group-to-group' and 'individual-to-world' comparisons.")
+    parser.add_argument("--step", type=int, action="store", dest="step", help="Number of days between the starts of consecutive windows (default: 1)", default=1)
+    parser.add_argument("--bootstrap", type=int, action="store", dest="n_bootstrap", help="Also report a confidence interval for each distance, from this many bootstrap replicates", default=0)
+    parser.add_argument("--permutations", type=int, action="store", dest="n_permutations", help="Also report a p-value for each distance, from this many permutation replicates", default=0)
+    parser.add_argument("--alpha", type=float, action="store", dest="alpha", help="Confidence intervals are at level 1 - alpha (default: 0.05)", default=0.05)
+    parser.add_argument("--seed", type=int, action="store", dest="seed", help="Random seed for --bootstrap and --permutations")
     args = parser.parse_args()
 
-    measure_distances(args.input_fn, args.out_fn, args.type, group_key=args.group_key, min_group_size=args.min_group_size)
+    if args.n_bootstrap or args.n_permutations:
+        if args.window or args.cache_dir or args.upper:
+            print("error: --bootstrap and --permutations cannot be combined with --window, --cache or --upper")
+            exit(1)
+        measure_significance(args.input_fn, args.out_fn, args.type, group_key=args.group_key,
+                                min_group_size=args.min_group_size,
+                                n_bootstrap=args.n_bootstrap, n_permutations=args.n_permutations,
+                                alpha=args.alpha, seed=args.seed, workers=args.workers)
+    elif args.window:
+        if args.upper:
+            print("error: --upper cannot be combined with --window")
+            exit(1)
+        measure_rolling_distances(args.input_fn, args.out_fn, args.type, args.window, step=args.step,
+                                    group_key=args.group_key, min_group_size=args.min_group_size,
+                                    workers=args.workers, cache_dir=args.cache_dir)
+    else:
+        measure_distances(args.input_fn, args.out_fn, args.type, group_key=args.group_key, min_group_size=args.min_group_size,
+                            workers=args.workers, cache_dir=args.cache_dir, upper=args.upper)
@@ -1,22 +1,43 @@
 
 import os
 from acculturation.datareaders import JsonDataReader, EmlDataReader, CsvDataReader
-from acculturation.preprocessing import preprocess_docs
+from acculturation.datareaders import MboxDataReader, ZipDataReader, TarDataReader
+from acculturation.compression import compression_ext, strip_compression_ext
+from acculturation.preprocessing import preprocess_docs, preprocess_docs_incremental
 
 # Different data readers for different
 # kinds of input data files
 FORMAT_2_READER = {
     'eml': EmlDataReader,
+    'mbox': MboxDataReader,
+    # .zip and .tar(.gz/.bz2/.xz) archives of .eml files
+    'zip': ZipDataReader,
+    'tar': TarDataReader,
     'json': JsonDataReader,
     'csv': CsvDataReader
 }
 
-def preprocess_data(input_fn, lex_fn, out_fn, dformat, text_key="text"):
+def preprocess_data(input_fn, lex_fn, out_fn, dformat, text_key="text",
+                        wildcard_mode='stem', workers=1, ordered=True,
+                        out_format='json', columns=('from', 'to', 'date'),
+                        incremental=False, parse_workers=1, sidecar=False,
+                        shards=1):
     Constructor = FORMAT_2_READER[dformat]
-    if dformat == 'eml':
+    if issubclass(Constructor, EmlDataReader):
         text_key = 'body'
-    docs = Constructor(input_fn)
-    preprocess_docs(docs, lex_fn, out_fn, text_key=text_key)
+        docs = Constructor(input_fn, workers=parse_workers)
+    else:
+        docs = Constructor(input_fn)
+    if incremental:
+        preprocess_docs_incremental(docs, lex_fn, out_fn, text_key=text_key,
+                                        wildcard_mode=wildcard_mode)
+        return
+    preprocess_docs(docs, lex_fn, out_fn, text_key=text_key,
+                        wildcard_mode=wildcard_mode,
+                        workers=workers, ordered=ordered,
+                        out_format=out_format, columns=columns,
+                        sidecar_fields=list(columns) + ['terms'] if sidecar else None,
+                        shards=shards)
 
 
 
@@ -26,14 +47,49 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--inputfn", type=str, action="store", dest="inputfn", help="Filepath to input data. If filepath is a directory, all files with matching data format will be loaded", required=True)
-    parser.add_argument("-l", "--lexfn", type=str, action="store", dest="lex_fn", help="Lexicon CSV filename for mapping words to categories", required=True)
-    parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for preprocessed data", required=True)
-    parser.add_argument("-f", "--format", choices=['eml', 'csv', 'json'], action="store", dest="format", help="Input data format (supported: eml, csv, json)", required=True)
-    parser.add_argument("-t", "--textkey", type=str, action="store", dest="text_key", help="Key to access text of document (only necessary for csv and json data formats, set to 'body' for eml data)", default="text")
+    parser.add_argument("-l", "--lexfn", type=str, action="store", dest="lex_fn", help="Lexicon CSV filename for mapping words to categories (or a lexicon compiled with `python -m acculturation.lexicon`)", required=True)
+    parser.add_argument("-o", "--outfn", type=str, action="store", dest="out_fn", help="Output filename for preprocessed data. Output is compressed if outfn ends in .gz, .bz2 or .xz (e.g. enron.json.gz)", required=True)
+    parser.add_argument("-f", "--format", choices=sorted(FORMAT_2_READER.keys()), action="store", dest="format", help="Input data format (supported: eml, mbox, zip and tar archives of eml files, csv, json)", required=True)
+    parser.add_argument("-t", "--textkey", type=str, action="store", dest="text_key", help="Key to access text of document (only necessary for csv and json data formats, set to 'body' for eml, mbox, zip and tar data)", default="text")
+    parser.add_argument("-w", "--wildcard", choices=['stem', 'prefix'], action="store", dest="wildcard_mode", help="How lexicon entries ending in '*' match words: by Porter stem, or by prefix as in LIWC (default: stem)", default="stem")
+    parser.add_argument("--workers", type=int, action="store", dest="workers", help="Number of processes to preprocess documents with (default: 1)", default=1)
+    parser.add_argument("--parse-workers", type=int, action="store", dest="parse_workers", help="Number of processes to parse emails with (eml, mbox, zip and tar formats only, default: 1)", default=1)
+    parser.add_argument("--unordered", action="store_true", dest="unordered", help="With --workers, write documents as soon as they are processed instead of in input order")
+    parser.add_argument("--columnar", action="store_true", dest="columnar", help="Write a columnar corpus directory (category counts plus metadata columns) instead of line-by-line json. Measurement loads columnar corpora much faster.")
+    parser.add_argument("--columns", type=str, nargs="+", action="store", dest="columns", help="Document keys to keep as metadata columns in columnar output, e.g. to add group keys (default: from to date)", default=['from', 'to', 'date'])
+    parser.add_argument("--sidecar", action="store_true", dest="sidecar", help="Also write the --columns keys and category counts of each document to a small sidecar file next to outfn (e.g. enron.json.fields), which measure.py reads instead of the full documents")
+    parser.add_argument("--shards", type=int, action="store", dest="shards", help="Write json output as this many roughly equal shard files plus a manifest (outfn + '.shards'), which measure.py can read in parallel (default: 1, a single file)", default=1)
+    parser.add_argument("--incremental", action="store_true", dest="incremental", help="Only process input files that are new or changed since the last run, appending to outfn. Progress is tracked in outfn + '.manifest', so interrupted runs can simply be restarted.")
     args = parser.parse_args()
 
-    if args.out_fn.split(".")[-1] != "json":
-        print("error: outfn must end in '.json'")
+    if args.incremental and (args.columnar or args.workers > 1 or args.sidecar or args.shards > 1):
+        print("error: --incremental cannot be combined with --columnar, --workers, --sidecar or --shards")
         exit(1)
 
-    preprocess_data(args.inputfn, args.lex_fn, args.out_fn, args.format, text_key=args.text_key)
+    if args.columnar and (args.sidecar or args.shards > 1):
+        print("error: --sidecar and --shards only apply to json output")
+        exit(1)
+
+    if args.incremental and compression_ext(args.out_fn):
+        print("error: --incremental output cannot be compressed")
+        exit(1)
+
+    archive_exts = getattr(FORMAT_2_READER[args.format], 'ARCHIVE_EXTS', None)
+    if archive_exts and os.path.isfile(args.inputfn) and \
+            not any(args.inputfn.lower().endswith('.' + ext) for ext in archive_exts):
+        print("error: -f %s only reads .%s archives" % (args.format, ", .".join(archive_exts)))
+        exit(1)
+
+    if not args.columnar and strip_compression_ext(args.out_fn).split(".")[-1] != "json":
+        print("error: outfn must end in '.json' (or '.json.gz', '.json.bz2', '.json.xz')")
+        exit(1)
+
+    preprocess_data(args.inputfn, args.lex_fn, args.out_fn, args.format, text_key=args.text_key,
+                        wildcard_mode=args.wildcard_mode,
+                        workers=args.workers, ordered=not args.unordered,
+                        out_format='columnar' if args.columnar else 'json',
+                        columns=args.columns,
+                        incremental=args.incremental,
+                        parse_workers=args.parse_workers,
+                        sidecar=args.sidecar,
+                        shards=args.shards)
@@ -0,0 +1,22 @@
+import random
+
+from acculturation.jensen_shannon import measure_js_distances
+
+
+def make_documents(n=300, seed=0):
+    rng = random.Random(seed)
+    return [{'group': rng.choice(['a', 'b', 'c']),
+             'terms': {t: rng.randint(1, 3) for t in rng.sample('pqrstuvw', 3)}}
+                for _ in range(n)]
+
+
+def test_streaming_with_sampling_samples():
+    documents = make_documents()
+    sampled = measure_js_distances(documents, 'group', sampling=True, sampsize=50,
+                                    seed=1, min_group_size=0, verbose=False)
+    both = measure_js_distances(documents, 'group', sampling=True, sampsize=50,
+                                    streaming=True, seed=1, min_group_size=0, verbose=False)
+    streamed = measure_js_distances(documents, 'group', streaming=True,
+                                    min_group_size=0, verbose=False)
+    assert both == sampled
+    assert both != streamed
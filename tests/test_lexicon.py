@@ -0,0 +1,35 @@
+import pickle
+
+from acculturation.lexicon import CSVLexicon, CompiledLexicon, compile_lexicon
+
+LEXICON_CSV = """Word,Positive,Negative
+good,1,
+good,1,
+bad,,1
+happ*,1,
+happ*,1,
+"""
+
+
+def make_lexicons(tmp_path, wildcard_mode='stem'):
+    lex_fn = tmp_path / "lexicon.csv"
+    lex_fn.write_text(LEXICON_CSV)
+    compiled_fn = str(tmp_path / "lexicon.lexc")
+    compile_lexicon(str(lex_fn), compiled_fn)
+    return (CSVLexicon(str(lex_fn), wildcard_mode=wildcard_mode),
+            CompiledLexicon(compiled_fn, wildcard_mode=wildcard_mode))
+
+
+def test_repeated_entries_count_once(tmp_path):
+    words = "good bad happy good".split()
+    for lex in make_lexicons(tmp_path, wildcard_mode='prefix'):
+        assert lex.get_category_vector_from_words(words).tolist() == [3, 1]
+        assert lex.get_category_counts_from_words(words) == {'Positive': 3, 'Negative': 1}
+
+
+def test_compiled_lexicon_pickles(tmp_path):
+    _, lex = make_lexicons(tmp_path)
+    copy = pickle.loads(pickle.dumps(lex))
+    assert copy.wildcard_mode == lex.wildcard_mode
+    words = "good bad happy".split()
+    assert copy.get_categories_from_words(words) == lex.get_categories_from_words(words)
@@ -0,0 +1,25 @@
+import os
+import shutil
+
+from measure import measure_distances
+from preprocess import preprocess_data
+
+SAMPLE_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "sample-data")
+
+
+def test_measure_incremental_output_dir(tmp_path):
+    in_dir = tmp_path / "in"
+    shutil.copytree(os.path.join(SAMPLE_DIR, "enron", "brawner-s"), in_dir)
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    out_fn = str(out_dir / "enron.json")
+    lex_fn = os.path.join(SAMPLE_DIR, "sample-lexicon.csv")
+    preprocess_data(str(in_dir), lex_fn, out_fn, 'eml', incremental=True)
+    # The manifest sits next to the output and is not read as documents
+    assert os.path.exists(out_fn + '.manifest')
+
+    from_dir, from_file = str(tmp_path / "dir.csv"), str(tmp_path / "file.csv")
+    measure_distances(str(out_dir), from_dir, 'dyadic')
+    measure_distances(out_fn, from_file, 'dyadic')
+    with open(from_dir) as f, open(from_file) as g:
+        assert f.read() == g.read()